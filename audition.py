@@ -0,0 +1,150 @@
+"""Try several spellings of the name on a small sample of lines before running all of step 2.
+
+Picks a sample of the lines step 2 would generate, spread over speaker folders and text
+lengths (the speed buckets), always including some lines of PROBLEM_SPEAKERS, and
+generates every candidate spelling of them in one run on the same loaded model. The
+results go side by side into AUDITION_DIR:
+
+    data/Audition/01_Alphinaud_12345/original.wav   the line as spoken in the game
+    data/Audition/01_Alphinaud_12345/v'zicksa.wav   one WAV per candidate
+    data/Audition/01_Alphinaud_12345/vee-zicksa.wav
+    data/Audition/audition.txt                      the sentence and text of every line
+
+    python audition.py "v'zicksa" "vee-zicksa" "vizzicksa"
+
+Everything else (backend, references, NFE_STEP, BATCH_SIZE, the quality gate) comes from
+step2_generate_customdata.py. Results go through step 2's output cache, so running the
+real step 2 afterwards with the chosen name reuses the sample lines.
+"""
+import os
+import re
+import json
+import shutil
+import argparse
+import numpy as np
+import instrumentation
+import step2_generate_customdata as step2
+from output_cache import OutputCache, cache_key, link_or_copy
+
+AUDITION_DIR = "data/Audition"  # Emptied at the start of every audition
+CANDIDATE_NAMES = ["v'zicksa"]  # Used when no names are given on the command line
+SAMPLE_SIZE = 30  # Lines per candidate
+# Speakers whose lines often come out wrong. Their lines are always in the sample, they'd
+# otherwise only turn up late in a full run.
+PROBLEM_SPEAKERS = ["Alphinaud"]
+PROBLEM_LINES_PER_SPEAKER = 3
+SAMPLE_SEED = 0  # Change to audition a different sample
+
+def speaker_of(rel_json):
+    return os.path.dirname(rel_json) or "."
+
+def is_problem_speaker(rel_json, problem_speakers):
+    parts = os.path.normpath(rel_json).split(os.sep)[:-1]
+    return any(speaker in parts for speaker in problem_speakers)
+
+def stratified_sample(table, size, problem_speakers=(), per_problem_speaker=PROBLEM_LINES_PER_SPEAKER, seed=SAMPLE_SEED):
+    """Pick up to size rows of a JobTable, spread over (speaker folder, length bucket):
+    one line of every stratum in random order, then a second of every stratum, and so on.
+    The first lines of each problem speaker come first. Returns the row indices."""
+    rng = np.random.default_rng(seed)
+    rel_jsons = table.columns["rel_json"].tolist()
+    buckets = step2.length_buckets(table.columns["length"])
+    strata = {}
+    for i, rel_json in enumerate(rel_jsons):
+        strata.setdefault((speaker_of(rel_json), int(buckets[i])), []).append(i)
+    # A line's rank is its position in its shuffled stratum, rank 0 of every stratum first
+    rank = np.empty(len(table), dtype=np.int64)
+    for indices in strata.values():
+        rank[rng.permutation(indices)] = np.arange(len(indices))
+    order = np.lexsort((rng.random(len(table)), rank)).tolist()
+
+    chosen = []
+    for speaker in problem_speakers:
+        lines = [i for i in order if is_problem_speaker(rel_jsons[i], [speaker])]
+        chosen.extend(i for i in lines[:per_problem_speaker] if i not in chosen)
+    taken = set(chosen)
+    chosen.extend(i for i in order if i not in taken)
+    return chosen[:size]
+
+def safe_name(name):
+    """A candidate spelling as a file name."""
+    return re.sub(r"[^\w'\- ]", "_", name).strip() or "_"
+
+def audition_jobs(table, contents_by_line, sample, names, pack=None):
+    """The jobs to generate every candidate name for the sampled lines, written to
+    AUDITION_DIR instead of CustomData. Returns (jobs, [(line folder, row)])."""
+    rows = [table.row(i) for i in sample]
+    lines = []
+    jobs = []
+    for number, row in enumerate(rows, 1):
+        stem = os.path.splitext(os.path.basename(row["rel_json"]))[0]
+        folder = os.path.join(AUDITION_DIR, safe_name(f"{number:02d}_{speaker_of(row['rel_json']).replace(os.sep, '_')}_{stem}"))
+        lines.append((folder, row))
+    for name in names:
+        gen_texts, speeds = step2.prepare_gen_texts([row["sentence"] for row in rows], name)
+        for (folder, row), gen_text, speed in zip(lines, gen_texts, speeds.tolist()):
+            job = step2.job_from_row(dict(row, gen_text=gen_text, speed=speed,
+                                          cache_key=cache_key(gen_text, row["ref_hash"], step2.NFE_STEP, speed, None, name)),
+                                     contents_by_line[row["rel_json"]], pack, name)
+            wav_path = os.path.join(folder, safe_name(name) + ".wav")
+            job.update(file=os.path.join(os.path.basename(folder), safe_name(name)), new_wav_path=wav_path,
+                       output_path=wav_path, new_ogg_path=None, new_json_path=wav_path[:-len(".wav")] + ".json")
+            jobs.append(job)
+    return jobs, lines
+
+def write_originals(lines, pack=None):
+    """Put each line's game audio next to the candidates, to compare against."""
+    for folder, row in lines:
+        os.makedirs(folder, exist_ok=True)
+        original = step2.original_reference(row["rel_json"])
+        try:
+            if pack is not None:
+                pack.write_wav(row["rel_json"], os.path.join(folder, "original.wav"))
+            else:
+                link_or_copy(original, os.path.join(folder, "original" + os.path.splitext(original)[1]))
+        except (OSError, KeyError) as e:
+            print(f"No original audio for {row['rel_json']}: {e}")
+
+def write_summary(lines, names):
+    """audition.txt: every line's sentence and what each candidate made of it, plus the
+    lines that failed the quality gate."""
+    failed = {name: 0 for name in names}
+    with open(os.path.join(AUDITION_DIR, "audition.txt"), "w", encoding="utf-8") as f:
+        for folder, row in lines:
+            f.write(f"{os.path.basename(folder)}  ({row['rel_json']})\n  sentence: {row['sentence']}\n")
+            for name in names:
+                json_path = os.path.join(folder, safe_name(name) + ".json")
+                with open(json_path, "r", encoding="utf-8") as g:
+                    data = json.load(g)
+                problems = data.get("quality_problems")
+                failed[name] += bool(problems)
+                f.write(f"  {name}: {data['generation_parameters']['gen_text']}"
+                        + (f"  [{', '.join(problems)}]" if problems else "") + "\n")
+            f.write("\n")
+    return failed
+
+def audition(names, size=SAMPLE_SIZE):
+    pack, ref_index = step2.load_references()
+    output_cache = OutputCache(step2.OUTPUT_CACHE_DIR) if step2.OUTPUT_CACHE_DIR else None
+    table, contents_by_line = step2.plan_jobs(step2.iter_lines(pack), ref_index)
+    sample = stratified_sample(table, size, PROBLEM_SPEAKERS)
+    speakers = len({speaker_of(table.columns["rel_json"][i]) for i in sample})
+    print(f"Auditioning {len(names)} names on {len(sample)} of {len(table)} lines from {speakers} speaker folders.")
+
+    shutil.rmtree(AUDITION_DIR, ignore_errors=True)
+    jobs, lines = audition_jobs(table, contents_by_line, sample, names, pack)
+    write_originals(lines, pack)
+    step2.generate_jobs(jobs, output_cache, total=len(jobs), ref_index=ref_index)
+    instrumentation.get("step2").finish()
+
+    failed = write_summary(lines, names)
+    for name in names:
+        print(f"{name}: {failed[name]} of {len(lines)} lines failed the quality gate")
+    print(f"Listen to the candidates side by side in {AUDITION_DIR}, the texts are in {AUDITION_DIR}/audition.txt.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a sample of lines with several name spellings to compare.")
+    parser.add_argument("names", nargs="*", default=CANDIDATE_NAMES, help="Candidate spellings of the name")
+    parser.add_argument("--lines", type=int, default=SAMPLE_SIZE, help="Number of lines in the sample")
+    args = parser.parse_args()
+    audition(args.names, args.lines)
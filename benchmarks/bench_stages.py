@@ -0,0 +1,199 @@
+"""Time every stage of the pipeline on a synthetic Data tree, on CPU only.
+
+Builds a synthetic XIVV Data tree (see synthetic_data.py) in a temp folder and runs the
+real code of each stage on it, with StubTTS in place of F5-TTS:
+
+    step1            filter, copy and decode (then again with nothing changed: step1_rerun)
+    lexicon          step 1.5 over OrigData
+    step2_prepare    text shaping of every line
+    step2_reference  reference index and choice of reference for every line
+    step2_generate   the rest of step 2 (jobs, stub inference, writing WAVs and JSONs)
+    step3            WAV to OGG, skipped if neither ffmpeg nor PyAV is installed
+
+Results are printed and written as JSON. Pass --baseline with an earlier result to fail
+(exit code 1) when a stage got slower than --max-regression allows, e.g. in CI:
+
+    python benchmarks/bench_stages.py --lines 5000 --output bench.json
+    python benchmarks/bench_stages.py --lines 5000 --baseline bench.json
+
+Step 1's worker processes are started the platform's way. --start-method spawn runs them
+like on Windows from Linux too, where the default (fork) would hide settings that don't
+reach the workers.
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+import multiprocessing
+import importlib.util
+from contextlib import redirect_stdout
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import step1_generate_newdata as step1
+import step2_generate_customdata as step2
+import step3_convert_wav_to_ogg as step3
+import instrumentation
+from lexicon_matcher import LexiconMatcher
+from reference_index import ReferenceIndex
+from synthetic_data import build_data_tree
+
+_spec = importlib.util.spec_from_file_location("step1_5_lexicon", os.path.join(ROOT, "step1-5-lexicon.py"))
+lexicon_step = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(lexicon_step)
+
+def encoder_available():
+    try:
+        import av
+        return "pyav"
+    except ImportError:
+        pass
+    try:
+        subprocess.run(["ffmpeg", "-version"], capture_output=True, check=True)
+        return "ffmpeg"
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+def timed(results, name, items, work):
+    """Run work() and record its time under name. items is a count, or a function that
+    counts afterwards. Returns whatever work() returns."""
+    start = time.perf_counter()
+    # The steps print per file, that would be timing the terminal
+    with redirect_stdout(io.StringIO()):
+        value = work()
+    elapsed = time.perf_counter() - start
+    count = items() if callable(items) else items
+    results[name] = {"seconds": round(elapsed, 4), "items": count,
+                     "items_per_second": round(count / elapsed, 2) if elapsed else None}
+    print(f"{name:>16}: {elapsed:8.2f}s  {count:>7} items  {count / elapsed if elapsed else 0:10.1f} items/s")
+    return value
+
+def count_files(directory, ext):
+    return sum(1 for _, _, files in os.walk(directory) for file in files if file.endswith(ext))
+
+def run_stages(directory, args):
+    results = {}
+    data_dir = os.path.join(directory, "Data")
+    work = os.path.join(directory, "work")
+
+    print(f"Building {args.lines} synthetic lines in {data_dir}...")
+    matched = build_data_tree(data_dir, args.lines, args.speakers, args.match_rate, args.seed)
+    if not matched:
+        sys.exit(f"None of the {args.lines} lines mention the player, use more --lines or a higher --match-rate.")
+    instrumentation.METRICS_DIR = os.path.join(work, "metrics")
+
+    step1.SOURCE_DIR = data_dir
+    step1.NEW_DATA_DIR = os.path.join(work, "OrigData")
+    step1.ORIGINAL_OGG_DIR = os.path.join(work, "OriginalOggs")
+    step1.MANIFEST_PATH = os.path.join(work, "step1_manifest.json")
+    step1.DEPLOY_MANIFEST_PATH = os.path.join(work, "deploy_manifest.json")
+    step1.WORKERS = args.workers
+    timed(results, "step1", args.lines, step1.copy_and_convert_files)
+    timed(results, "step1_rerun", args.lines, step1.copy_and_convert_files)
+
+    lexicon_step.INDEX_PATH = os.path.join(work, "lexicon_index.json")
+    lexicon = lexicon_step.load_lexicon(os.path.join(ROOT, "lexicon.json"))
+    matcher = LexiconMatcher(lexicon)
+    timed(results, "lexicon", matched, lambda: lexicon_step.process_directory(step1.NEW_DATA_DIR, matcher, lexicon))
+
+    step2.NEW_DATA_DIR = step1.NEW_DATA_DIR
+    step2.CUSTOM_DATA_DIR = os.path.join(work, "CustomData")
+    step2.TTS_BACKEND = "stub"
+    step2.REF_CACHE_DIR = os.path.join(work, "RefCache")
+    step2.REF_INDEX_PATH = os.path.join(work, "reference_index.json")
+    step2.OUTPUT_CACHE_DIR = None
+    step2.FUSED_OGG_OUTPUT = False
+    step2.PLAN_PATH = os.path.join(work, "step2_plan.npz")
+    lines = list(step2.iter_lines())
+    sentences = [contents.get("sentence", "") for _, contents in lines]
+    timed(results, "step2_prepare", len(sentences),
+          lambda: step2.prepare_gen_texts(sentences, step2.SPECIFIED_NAME))
+
+    def choose_references():
+        ref_index = ReferenceIndex(step2.NEW_DATA_DIR, step2.REF_INDEX_PATH).build()
+        for rel_json, _ in lines:
+            ref_index.choose(os.path.join(step2.NEW_DATA_DIR, rel_json[:-len(".json")] + ".wav"), step2.REFERENCE_SEED)
+    timed(results, "step2_reference", len(lines), choose_references)
+    timed(results, "step2_generate", lambda: count_files(step2.CUSTOM_DATA_DIR, ".wav"),
+          step2.process_jsons_and_generate)
+
+    encoder = encoder_available()
+    if encoder is None:
+        print("Neither ffmpeg nor PyAV is installed, skipping step 3.")
+        results["step3"] = None
+    else:
+        step3.CUSTOM_DATA_DIR = step2.CUSTOM_DATA_DIR
+        step3.CONVERTED_DATA_DIR = os.path.join(work, "FinalOggData")
+        step3.STATE_PATH = os.path.join(work, "step3_state.json")
+        step3.USE_PYAV = encoder == "pyav"
+        step3.WORKERS = args.workers
+        timed(results, "step3", lambda: count_files(step3.CONVERTED_DATA_DIR, ".ogg"),
+              step3.convert_custom_wav_to_ogg)
+    return results, matched
+
+def compare(results, baseline, max_regression):
+    """Return the stages that got slower than max_regression (a fraction) allows."""
+    slower = []
+    for name, result in results.items():
+        old = baseline.get("stages", {}).get(name)
+        if not result or not old or not result["items_per_second"] or not old["items_per_second"]:
+            continue
+        change = result["items_per_second"] / old["items_per_second"] - 1
+        print(f"{name:>16}: {change:+7.1%} items/s vs baseline")
+        if change < -max_regression:
+            slower.append(name)
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=5000, help="Number of synthetic lines (JSON + OGG)")
+    parser.add_argument("--speakers", type=int, default=100)
+    parser.add_argument("--match-rate", type=float, default=0.05, help="Fraction of lines that mention the player")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes/threads for step 1 and step 3")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Earlier results to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="Allowed drop in items/s per stage")
+    parser.add_argument("--keep", help="Build the tree here and keep it, instead of a temp folder")
+    parser.add_argument("--start-method", choices=multiprocessing.get_all_start_methods(),
+                        help="How worker processes are started, e.g. spawn as on Windows")
+    args = parser.parse_args()
+    if args.start_method:
+        multiprocessing.set_start_method(args.start_method)
+
+    if args.keep:
+        shutil.rmtree(args.keep, ignore_errors=True)
+        results, matched = run_stages(args.keep, args)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            results, matched = run_stages(directory, args)
+
+    report = {
+        "params": {"lines": args.lines, "speakers": args.speakers, "match_rate": args.match_rate,
+                   "matched": matched, "workers": args.workers, "seed": args.seed},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count()},
+        "stages": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline, args.max_regression)
+        if slower:
+            print(f"Slower than the baseline allows: {', '.join(slower)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Compare step 1's old json.load/json.dumps filter with the raw bytes prefilter.
+
+Builds a synthetic tree of small XIVV style JSONs in a temp folder and times both
+filters over it. Only the filtering is timed, no copying or decoding.
+
+    python benchmarks/bench_step1_prefilter.py --files 100000
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import step1_generate_newdata as step1
+
+WORDS = ["the", "crystal", "light", "we", "must", "hurry", "to", "Limsa", "Lominsa", "friend",
+         "Archon", "arcane", "Gridania", "you", "have", "done", "well", "again", "Scions"]
+
+def make_sentence(rng, match_rate):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(4, 20))]
+    if rng.random() < match_rate:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(["_NAME_", "_FIRSTNAME_", "Arc,", "Arc!"]))
+    return " ".join(words) + "."
+
+def build_tree(directory, count, match_rate=0.05, false_positive_rate=0.01, seed=1):
+    rng = random.Random(seed)
+    for i in range(count):
+        speaker_dir = os.path.join(directory, f"Speaker{i % 200:03d}")
+        if i < 200:
+            os.makedirs(speaker_dir, exist_ok=True)
+        contents = {
+            "speaker": f"Speaker{i % 200:03d}",
+            "sentence": make_sentence(rng, match_rate),
+            "npcid": str(i),
+        }
+        if rng.random() < false_positive_rate:
+            # A hit outside of the sentence, the old filter counts these
+            contents["note"] = "_NAME_ placeholder in metadata"
+        with open(os.path.join(speaker_dir, f"{i}.json"), "w", encoding="utf-8") as f:
+            json.dump(contents, f)
+
+def legacy_matches(json_path):
+    """Step 1's filter before the prefilter: parse, re-serialise and search the lot."""
+    with open(json_path, "r", encoding="utf-8") as f:
+        contents = json.load(f)
+        json_text = json.dumps(contents)
+    return step1.FILTER_PATTERN.search(json_text) is not None
+
+def time_filter(name, matches, paths):
+    start = time.perf_counter()
+    hits = sum(1 for path in paths if matches(path))
+    elapsed = time.perf_counter() - start
+    print(f"{name:>10}: {elapsed:7.2f}s  {len(paths) / elapsed:10.0f} files/s  {hits} matches")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=100000, help="Number of synthetic JSONs")
+    parser.add_argument("--match-rate", type=float, default=0.05, help="Fraction of sentences with a name")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"Building {args.files} synthetic JSONs in {directory}...")
+        build_tree(directory, args.files, args.match_rate)
+        paths = [os.path.join(directory, rel) for rel, _, _ in step1.scan_source(directory)]
+
+        # Warm the OS file cache so both runs read from memory
+        for path in paths:
+            with open(path, "rb") as f:
+                f.read()
+
+        legacy = time_filter("json", legacy_matches, paths)
+        prefilter = time_filter("prefilter", step1.json_matches, paths)
+        print(f"Speedup: {legacy / prefilter:.1f}x")
+
+if __name__ == "__main__":
+    main()
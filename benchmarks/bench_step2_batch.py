@@ -0,0 +1,56 @@
+"""Measure step 2's lines per second at different batch sizes, to pick BATCH_SIZE.
+
+Takes a sample of the lines step 2 would generate from data/OrigData and generates them
+into a temp folder once per batch size. Nothing is written to CustomData.
+
+    python benchmarks/bench_step2_batch.py --lines 64 --batch-sizes 1,2,4,8
+    python benchmarks/bench_step2_batch.py --backend stub   # no GPU needed
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import step2_generate_customdata as step2
+from reference_index import ReferenceIndex
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=64, help="Number of lines to sample")
+    parser.add_argument("--batch-sizes", default="1,2,4,8", help="Comma separated batch sizes to try")
+    parser.add_argument("--backend", default=step2.TTS_BACKEND, choices=["f5", "worker", "stub"])
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the sample of lines")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Point the output at the temp folder so every line counts as pending
+        step2.CUSTOM_DATA_DIR = directory
+        step2.TTS_BACKEND = args.backend
+        ref_index = ReferenceIndex(step2.NEW_DATA_DIR, step2.REF_INDEX_PATH).build()
+        table, contents_by_line = step2.plan_jobs(step2.iter_lines(), ref_index)
+        jobs, _ = step2.jobs_from_table(table, contents_by_line)
+        jobs = random.Random(args.seed).sample(jobs, min(args.lines, len(jobs)))
+        print(f"Sampled {len(jobs)} lines.")
+
+        tts = step2.get_tts()
+        # Warm up so the first batch size doesn't pay for CUDA initialisation
+        step2.generate_batch(tts, jobs[:1])
+
+        results = []
+        for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+            batches = step2.make_batches(jobs, batch_size)
+            start = time.perf_counter()
+            for batch in batches:
+                step2.generate_batch(tts, batch)
+            elapsed = time.perf_counter() - start
+            results.append((batch_size, len(batches), elapsed))
+
+    print()
+    for batch_size, batch_count, elapsed in results:
+        print(f"Batch size {batch_size:>3}: {batch_count:>4} batches, {elapsed:7.1f}s, {len(jobs) / elapsed:6.2f} lines/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Build a synthetic XIVV Data tree for benchmarks: speaker folders of JSON + OGG pairs.
+
+Sentences mention the player (Arc, _NAME_, _FIRSTNAME_, "Warrior of _NAME_") and lexicon
+words at roughly the rates of the real data. Lines that mention the player get an OGG whose
+length follows their sentence, some too short to be a good reference. The pipeline never
+decodes the other lines' OGGs, so they all get the same short clip, which keeps building
+a large tree quick.
+
+    python benchmarks/synthetic_data.py out/Data --lines 20000
+"""
+import io
+import os
+import json
+import random
+import argparse
+import numpy as np
+import soundfile as sf
+
+WORDS = ["the", "crystal", "light", "we", "must", "hurry", "to", "Limsa", "Lominsa", "friend",
+         "Archon", "arcane", "Gridania", "you", "have", "done", "well", "again", "Scions", "I",
+         "will", "not", "let", "them", "win", "our", "path", "lies", "east", "beyond", "walls"]
+LEXICON_WORDS = ["Alphinaud", "Alisaie", "Tataru", "Y'shtola", "Eorzea", "Sharlayan", "Aetheryte", "Chocobo"]
+NAME_TOKENS = ["_NAME_", "_NAME_", "_FIRSTNAME_", "Arc", "Arc"]
+MATCH_RATE = 0.05  # Lines that mention the player
+LEXICON_RATE = 0.15  # Lines with a word from the lexicon
+WARRIOR_RATE = 0.1  # Player mentions that are "Warrior of _NAME_"
+SHORT_LINE_RATE = 0.1  # Lines under 3s, which need another reference
+SAMPLE_RATE = 48000
+
+def make_sentence(rng, match_rate=MATCH_RATE):
+    """Returns the sentence and whether it mentions the player."""
+    mentioned = False
+    words = [rng.choice(WORDS) for _ in range(rng.randint(3, 25))]
+    if rng.random() < LEXICON_RATE:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(LEXICON_WORDS))
+    if rng.random() < match_rate:
+        mentioned = True
+        if rng.random() < WARRIOR_RATE:
+            token = "Warrior of " + rng.choice(NAME_TOKENS)
+        else:
+            token = rng.choice(NAME_TOKENS)
+        position = rng.randrange(len(words) + 1)
+        # Often addressed after a comma, which step 2 strips
+        words.insert(position, token + rng.choice([",", "", "!", ".", "?"]))
+    sentence = " ".join(words)
+    return sentence[0].upper() + sentence[1:] + rng.choice([".", "!", "?", "..."]), mentioned
+
+def make_audio(rng, seconds, samplerate=SAMPLE_RATE):
+    """A voice-ish clip: a wobbling tone with a little noise and short silences at the ends."""
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    pitch = rng.uniform(90, 260)
+    wav = 0.2 * np.sin(2 * np.pi * pitch * t + 3 * np.sin(2 * np.pi * 4 * t))
+    wav += 0.01 * np.random.default_rng(rng.randrange(2 ** 32)).standard_normal(len(t))
+    pad = int(0.1 * samplerate)
+    wav[:pad] = 0
+    wav[-pad:] = 0
+    return wav.astype(np.float32)
+
+def encode_ogg(wav, subtype):
+    buffer = io.BytesIO()
+    sf.write(buffer, wav, SAMPLE_RATE, format="OGG", subtype=subtype)
+    return buffer.getvalue()
+
+def build_data_tree(directory, lines, speakers=200, match_rate=MATCH_RATE, seed=1, ogg_subtype="VORBIS"):
+    """Write lines JSON + OGG pairs spread over speaker folders. Returns the number of
+    lines that mention the player."""
+    rng = random.Random(seed)
+    matched = 0
+    filler_ogg = encode_ogg(make_audio(rng, 1.0), ogg_subtype)
+    for i in range(lines):
+        speaker = f"Speaker{i % speakers:03d}"
+        speaker_dir = os.path.join(directory, speaker)
+        if i < speakers:
+            os.makedirs(speaker_dir, exist_ok=True)
+        sentence, mentioned = make_sentence(rng, match_rate)
+        matched += mentioned
+        contents = {"speaker": speaker, "sentence": sentence, "npcid": str(i)}
+        with open(os.path.join(speaker_dir, f"{i}.json"), "w", encoding="utf-8") as f:
+            json.dump(contents, f)
+
+        ogg = filler_ogg
+        if mentioned:
+            if rng.random() < SHORT_LINE_RATE:
+                seconds = rng.uniform(0.8, 2.5)
+            else:
+                seconds = min(12.0, 1.0 + len(sentence) * 0.06)
+            ogg = encode_ogg(make_audio(rng, seconds), ogg_subtype)
+        with open(os.path.join(speaker_dir, f"{i}.ogg"), "wb") as f:
+            f.write(ogg)
+    return matched
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", help="Folder to write the tree into")
+    parser.add_argument("--lines", type=int, default=20000, help="Number of JSON + OGG pairs")
+    parser.add_argument("--speakers", type=int, default=200)
+    parser.add_argument("--match-rate", type=float, default=MATCH_RATE, help="Fraction of lines that mention the player")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    matched = build_data_tree(args.directory, args.lines, args.speakers, args.match_rate, args.seed)
+    print(f"Wrote {args.lines} lines ({matched} mention the player) to {args.directory}")
@@ -0,0 +1,88 @@
+"""Decode OGGs only when they're used, and keep what was decoded.
+
+With LAZY_DECODE, step 1 doesn't convert any OGGs to WAVs, and step 2 only decodes the
+OGGs it actually uses as references. Decoded audio is kept as WAVs in a size bounded LRU
+cache on disk, so later runs don't decode again.
+"""
+import os
+import json
+import hashlib
+from collections import OrderedDict
+import soundfile as sf
+from output_cache import link_or_copy
+
+DECODED_CACHE_DIR = "data/DecodedCache"
+MAX_DISK_BYTES = 2 * 1024 ** 3
+
+class DecodedAudioCache:
+    def __init__(self, cache_dir=DECODED_CACHE_DIR, max_disk_bytes=MAX_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.decoded = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.disk = OrderedDict(json.load(f))  # key -> size in bytes
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.disk = OrderedDict()
+        self.disk_bytes = sum(self.disk.values())
+
+    def key(self, ogg_path):
+        st = os.stat(ogg_path)
+        stat_key = f"{os.path.abspath(ogg_path)}|{st.st_size}|{st.st_mtime_ns}"
+        return hashlib.sha1(stat_key.encode("utf-8")).hexdigest()
+
+    def save(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(list(self.disk.items()), f)
+        os.replace(tmp_path, self.index_path)
+
+    def wav_path(self, ogg_path):
+        """Return the path of the decoded WAV for an OGG, decoding it if it isn't cached."""
+        key = self.key(ogg_path)
+        path = os.path.join(self.cache_dir, key + ".wav")
+        if key in self.disk and os.path.exists(path):
+            self.disk.move_to_end(key)
+            return path
+
+        data, samplerate = sf.read(ogg_path, dtype="float32")
+        self.decoded += 1
+        tmp_path = path + ".tmp"
+        sf.write(tmp_path, data, samplerate, format="WAV", subtype="PCM_16")
+        os.replace(tmp_path, path)
+
+        self.disk[key] = os.path.getsize(path)
+        self.disk_bytes += self.disk[key]
+        while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 1:
+            evicted, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, evicted + ".wav"))
+            except FileNotFoundError:
+                pass
+        self.save()
+        return path
+
+class LazyOgg:
+    """An OGG reference, used by step 2 in place of a reference WAV path.
+    It's decoded through the DecodedAudioCache only when the reference cache needs it."""
+
+    _caches = {}  # One cache per folder per process
+
+    def __init__(self, ogg_path, sha1, cache_dir=DECODED_CACHE_DIR):
+        self.ogg_path = os.path.abspath(ogg_path)
+        self.sha1 = sha1
+        self.cache_dir = os.path.abspath(cache_dir)
+
+    def cache(self):
+        if self.cache_dir not in LazyOgg._caches:
+            LazyOgg._caches[self.cache_dir] = DecodedAudioCache(self.cache_dir)
+        return LazyOgg._caches[self.cache_dir]
+
+    def write_wav(self, path):
+        link_or_copy(self.cache().wav_path(self.ogg_path), path)
+
+    def __repr__(self):
+        return f"LazyOgg({self.ogg_path!r})"
@@ -0,0 +1,191 @@
+"""Copy the new voice lines into XIVV's Data folder, and put the original ones back.
+
+Instead of copying all of FinalOggData over the Data folder every time, deploy.py keeps a
+manifest of what it deployed (the size, mtime and inode of each file in FinalOggData and
+in the target) and only transfers lines that are new or changed since. Files are
+hardlinked where FinalOggData and the target are on the same drive and copied otherwise,
+always to a temporary name that is then renamed over the target, so the game never sees
+a half written OGG. A file that is already linked elsewhere (with FUSED_OGG_OUTPUT,
+FinalOggData links into step 2's output cache) is always copied, so the deployed file
+can't change along with it.
+
+    python deploy.py                   deploy what changed
+    python deploy.py --dry-run         only list it
+    python deploy.py --rollback        put back the original OGGs from data/OriginalOggs
+    python deploy.py --rollback Alphinaud/   only the lines under a folder
+
+Rollback is just as incremental: only lines that are still deployed are restored, and
+they're removed from the manifest. Lines that were deployed but are no longer in
+FinalOggData are rolled back by the next deploy. Step 1 recognises deployed lines (see
+DEPLOY_MANIFEST_PATH there), so running it again doesn't take them for new originals.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from output_cache import link_or_copy
+
+CONVERTED_DATA_DIR = "data/FinalOggData"  # Output of step 3
+TARGET_DIR = "N:/XIV_Voices/Data"  # XIVV's Data folder, the SOURCE_DIR of step 1
+ORIGINAL_OGG_DIR = "data/OriginalOggs"  # Backups made by step 1
+DEPLOY_MANIFEST_PATH = "data/deploy_manifest.json"
+WORKERS = 8  # Files transferred at once, helps most on network drives
+MANIFEST_SAVE_EVERY = 500  # Save the manifest every N files in case of a crash
+
+def file_stat(path):
+    """[size, mtime_ns, inode] of a file, or None if it doesn't exist. The inode tells a
+    file that was replaced by another one with the same size and mtime apart."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def scan_oggs(directory):
+    """Return {relative path: file_stat()} for every OGG in directory."""
+    found = {}
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".ogg") and not entry.name.endswith(".tmp.ogg"):
+                    # Not entry.stat(), it has no inode on Windows
+                    found[os.path.relpath(entry.path, directory)] = file_stat(entry.path)
+    return found
+
+def load_manifest(manifest_path):
+    """{relative OGG path: {"source": stat in FinalOggData, "target": stat in the target}}"""
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_manifest(manifest, manifest_path):
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+def deployed_stats(manifest_path):
+    """{relative OGG path: file_stat()} of the deployed files in the target, for step 1."""
+    return {rel_ogg: record["target"] for rel_ogg, record in load_manifest(manifest_path).items()}
+
+def plan_deploy(manifest, prefixes=None):
+    """Work out what a deploy has to do. Returns (lines to transfer, lines to roll back
+    because they're no longer in FinalOggData, number already up to date)."""
+    sources = scan_oggs(CONVERTED_DATA_DIR)
+    to_deploy = []
+    up_to_date = 0
+    for rel_ogg, source in sorted(sources.items()):
+        if not matches(rel_ogg, prefixes):
+            continue
+        record = manifest.get(rel_ogg)
+        if (record is not None and record["source"] == source
+                and file_stat(os.path.join(TARGET_DIR, rel_ogg)) == record["target"]):
+            up_to_date += 1
+        else:
+            to_deploy.append(rel_ogg)
+    removed = sorted(rel_ogg for rel_ogg in manifest if rel_ogg not in sources and matches(rel_ogg, prefixes))
+    return to_deploy, removed, up_to_date
+
+def matches(rel_ogg, prefixes):
+    if not prefixes:
+        return True
+    rel_ogg = rel_ogg.replace("\\", "/")
+    return any(rel_ogg.startswith(prefix.replace("\\", "/")) for prefix in prefixes)
+
+def deploy_file(rel_ogg):
+    source_path = os.path.join(CONVERTED_DATA_DIR, rel_ogg)
+    target_path = os.path.join(TARGET_DIR, rel_ogg)
+    source = file_stat(source_path)
+    if os.stat(source_path).st_nlink > 1:
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        tmp_path = target_path + ".tmp"
+        shutil.copy2(source_path, tmp_path)
+        os.replace(tmp_path, target_path)
+    else:
+        link_or_copy(source_path, target_path)
+    return rel_ogg, {"source": source, "target": file_stat(target_path)}
+
+def restore_file(rel_ogg):
+    """Put the original OGG back. It's always copied: a hardlink to the backup would let
+    step 1 copy the file onto itself."""
+    backup_path = os.path.join(ORIGINAL_OGG_DIR, rel_ogg)
+    target_path = os.path.join(TARGET_DIR, rel_ogg)
+    if not os.path.exists(backup_path):
+        raise FileNotFoundError(f"No backup of {rel_ogg} in {ORIGINAL_OGG_DIR}")
+    tmp_path = target_path + ".tmp"
+    shutil.copy2(backup_path, tmp_path)
+    os.replace(tmp_path, target_path)
+    return rel_ogg, None
+
+def run_transfers(work, rel_oggs, manifest, verb):
+    """Run work(rel_ogg) on a thread pool and record the results in the manifest.
+    A result of None removes the line from the manifest. Returns the number that failed."""
+    failed = 0
+    done = 0
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        futures = {pool.submit(work, rel_ogg): rel_ogg for rel_ogg in rel_oggs}
+        for future in as_completed(futures):
+            try:
+                rel_ogg, record = future.result()
+            except Exception as e:
+                print(f"Failed to {verb} {futures[future]}: {e}")
+                failed += 1
+                continue
+            if record is None:
+                manifest.pop(rel_ogg, None)
+            else:
+                manifest[rel_ogg] = record
+            done += 1
+            if done % MANIFEST_SAVE_EVERY == 0:
+                save_manifest(manifest, DEPLOY_MANIFEST_PATH)
+    save_manifest(manifest, DEPLOY_MANIFEST_PATH)
+    return failed
+
+def deploy(prefixes=None, dry_run=False):
+    manifest = load_manifest(DEPLOY_MANIFEST_PATH)
+    to_deploy, removed, up_to_date = plan_deploy(manifest, prefixes)
+    print(f"{len(to_deploy)} lines to deploy, {len(removed)} no longer in {CONVERTED_DATA_DIR} to roll back, "
+          f"{up_to_date} already up to date.")
+    if dry_run:
+        for rel_ogg in to_deploy:
+            print(f"Deploy: {rel_ogg}")
+        for rel_ogg in removed:
+            print(f"Roll back: {rel_ogg}")
+        return
+    failed = run_transfers(deploy_file, to_deploy, manifest, "deploy")
+    failed += run_transfers(restore_file, removed, manifest, "roll back")
+    print(f"Finished deploying to {TARGET_DIR}: {len(to_deploy) + len(removed) - failed} files written, {failed} failed.")
+
+def rollback(prefixes=None, dry_run=False):
+    manifest = load_manifest(DEPLOY_MANIFEST_PATH)
+    to_restore = sorted(rel_ogg for rel_ogg in manifest if matches(rel_ogg, prefixes))
+    print(f"{len(to_restore)} deployed lines to roll back.")
+    if dry_run:
+        for rel_ogg in to_restore:
+            print(f"Roll back: {rel_ogg}")
+        return
+    failed = run_transfers(restore_file, to_restore, manifest, "roll back")
+    print(f"Finished rolling back {TARGET_DIR}: {len(to_restore) - failed} original files restored, {failed} failed.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deploy FinalOggData into XIVV's Data folder, or roll it back.")
+    parser.add_argument("prefixes", nargs="*", help="Only lines under these folders, e.g. Alphinaud/")
+    parser.add_argument("--rollback", action="store_true", help="Restore the original OGGs from OriginalOggs")
+    parser.add_argument("--dry-run", action="store_true", help="Only list what would be transferred")
+    args = parser.parse_args()
+    if not os.path.isdir(TARGET_DIR):
+        print(f"Error: target folder {TARGET_DIR} not found, set TARGET_DIR at the top of deploy.py.")
+        sys.exit(1)
+    if args.rollback:
+        rollback(args.prefixes, args.dry_run)
+    else:
+        deploy(args.prefixes, args.dry_run)
@@ -0,0 +1,93 @@
+"""F5-TTS with an infer_batch() that generates several lines in one forward pass.
+
+F5TTS.infer() only takes one gen_text. For lines that share a reference and speed, the
+reference conditioning is the same, so they can go through the flow matching model
+together as one batch (F5-TTS's CFM.sample supports per item durations and masks) and
+then be vocoded one by one. This follows utils_infer.infer_batch_process, minus the
+chunking and cross-fading: lines too long to fit in one pass fall back to infer().
+"""
+import numpy as np
+import soundfile as sf
+import torch
+import torchaudio
+from f5_tts.api import F5TTS
+from f5_tts.infer.utils_infer import (
+    cfg_strength,
+    convert_char_to_pinyin,
+    hop_length,
+    preprocess_ref_audio_text,
+    sway_sampling_coef,
+    target_rms,
+)
+
+class BatchedF5TTS:
+    def __init__(self, **kwargs):
+        self.tts = F5TTS(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.tts, name)
+
+    def infer(self, *args, **kwargs):
+        return self.tts.infer(*args, **kwargs)
+
+    def infer_batch(self, ref_file, ref_text, gen_texts, file_waves=None, seed=None, nfe_step=32, speed=1.0, **kwargs):
+        """Generate every text in gen_texts with the same reference and speed.
+        Returns a list of (wav, sr, None) and writes each one to file_waves[i] if given."""
+        ref_file, ref_text = preprocess_ref_audio_text(ref_file, ref_text)
+        audio, sr = torchaudio.load(ref_file)
+        if audio.shape[0] > 1:
+            audio = torch.mean(audio, dim=0, keepdim=True)
+        rms = torch.sqrt(torch.mean(torch.square(audio)))
+        if rms < target_rms:
+            audio = audio * target_rms / rms
+        if sr != self.tts.target_sample_rate:
+            audio = torchaudio.transforms.Resample(sr, self.tts.target_sample_rate)(audio)
+        audio = audio.to(self.tts.device)
+
+        ref_seconds = audio.shape[-1] / self.tts.target_sample_rate
+        ref_text_len = len(ref_text.encode("utf-8"))
+        # Same limit F5-TTS uses to decide when a text has to be split into chunks
+        max_chars = int(ref_text_len / ref_seconds * (22 - ref_seconds))
+        ref_audio_len = audio.shape[-1] // hop_length
+
+        results = [None] * len(gen_texts)
+        batch = [i for i, text in enumerate(gen_texts) if len(text.encode("utf-8")) <= max_chars]
+        for i in range(len(gen_texts)):
+            if i not in batch:
+                file_wave = file_waves[i] if file_waves else None
+                results[i] = self.tts.infer(ref_file=ref_file, ref_text=ref_text, gen_text=gen_texts[i],
+                                            file_wave=file_wave, seed=seed, nfe_step=nfe_step, speed=speed)
+        if not batch:
+            return results
+
+        if seed is not None:
+            torch.manual_seed(seed)
+
+        texts = [ref_text + gen_texts[i] for i in batch]
+        durations = [ref_audio_len + int(ref_audio_len / ref_text_len * len(gen_texts[i].encode("utf-8")) / speed)
+                     for i in batch]
+
+        with torch.inference_mode():
+            generated, _ = self.tts.ema_model.sample(
+                cond=audio.expand(len(batch), -1),
+                text=convert_char_to_pinyin(texts),
+                duration=torch.tensor(durations, dtype=torch.long, device=self.tts.device),
+                steps=nfe_step,
+                cfg_strength=cfg_strength,
+                sway_sampling_coef=sway_sampling_coef,
+            )
+            generated = generated.to(torch.float32)
+
+            for row, (i, duration) in enumerate(zip(batch, durations)):
+                mel = generated[row:row + 1, ref_audio_len:duration, :].permute(0, 2, 1)
+                if self.tts.mel_spec_type == "vocos":
+                    wave = self.tts.vocoder.decode(mel)
+                else:
+                    wave = self.tts.vocoder(mel)
+                if rms < target_rms:
+                    wave = wave * rms / target_rms
+                wave = np.asarray(wave.squeeze().cpu().numpy(), dtype=np.float32)
+                if file_waves:
+                    sf.write(file_waves[i], wave, self.tts.target_sample_rate)
+                results[i] = (wave, self.tts.target_sample_rate, None)
+        return results
@@ -0,0 +1,219 @@
+"""Timing spans, counters and a progress line shared by all the steps.
+
+Instead of printing several lines per file, each step records how long each part of the
+work took per item (read, decode, reference, infer, write, encode...) and counts what
+happened. While it runs it shows one progress line, at most every PROGRESS_INTERVAL
+seconds. When it finishes it writes to METRICS_DIR:
+
+    <stage>.jsonl   one line per span (stage, span, item, seconds) and a summary line,
+                    of the latest run only (the run before is kept as <stage>.1.jsonl)
+    <stage>.prom    counters and latency histograms in Prometheus' text format
+
+Per-file messages are still there with VERBOSE = True in a step.
+
+    metrics = instrumentation.get("step2")
+    with metrics.span("infer", item=rel_json):
+        ...
+    metrics.count("generated")
+    metrics.progress(done, total)
+    metrics.finish()
+
+Worker processes can't reach the parent's metrics, so they time their work with Spans and
+return its observations, which the parent passes to merge().
+"""
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+METRICS_DIR = "data/metrics"  # Set to None to not write any metrics files
+PROGRESS_INTERVAL = 2.0  # Seconds between progress lines
+SPAN_LOG = True  # Write every span to the JSONL file, not only the summary
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+class Spans:
+    """Collects span timings in a worker process, to hand back to the parent's merge()."""
+
+    def __init__(self):
+        self.observations = []  # (span, seconds)
+
+    @contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observations.append((name, time.perf_counter() - start))
+
+class Metrics:
+    def __init__(self, stage, metrics_dir=None):
+        self.stage = stage
+        self.metrics_dir = metrics_dir
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.last_progress = 0.0
+        self.progress_start = None  # (time, done) of the first progress() call
+        self.progress_shown = False
+        self.span_lines = []
+        self.spans_written = False  # Whether this run has started its .jsonl yet
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds, item=None):
+        with self.lock:
+            self.histograms.setdefault(name, Histogram()).observe(seconds)
+            if SPAN_LOG and self.metrics_dir:
+                self.span_lines.append(json.dumps({"type": "span", "stage": self.stage, "span": name, "item": item,
+                                                   "seconds": round(seconds, 6)}, ensure_ascii=False))
+                if len(self.span_lines) >= 1000:
+                    self._flush_spans()
+
+    @contextmanager
+    def span(self, name, item=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, item)
+
+    def merge(self, observations, item=None):
+        """Record the observations of a worker process's Spans."""
+        for name, seconds in observations:
+            self.observe(name, seconds, item)
+
+    def progress(self, done, total=None, force=False):
+        """Show a progress line, unless one was shown less than PROGRESS_INTERVAL ago."""
+        now = time.perf_counter()
+        if self.progress_start is None:
+            self.progress_start = (now, done)
+        if not force and now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        elapsed = now - self.progress_start[0]
+        rate = (done - self.progress_start[1]) / elapsed if elapsed else 0.0
+        line = f"[{self.stage}] {done}"
+        if total:
+            line += f"/{total} ({done / total:.0%})"
+            if rate and done < total:
+                line += f", {(total - done) / rate / 60:.1f} min left"
+        line += f", {rate:.1f}/s"
+        with self.lock:
+            slowest = sorted(self.histograms.items(), key=lambda kv: -kv[1].sum)[:3]
+        if slowest:
+            line += " | " + ", ".join(f"{name} {h.sum / h.count * 1000:.0f}ms" for name, h in slowest)
+        if sys.stdout.isatty():
+            print("\r" + line.ljust(100), end="", flush=True)
+            self.progress_shown = True
+        else:
+            print(line, flush=True)
+
+    def log(self, message, verbose):
+        """Print a per-file message, only if the step's VERBOSE is on."""
+        if verbose:
+            if self.progress_shown:
+                print()
+                self.progress_shown = False
+            print(message)
+
+    def summary(self):
+        with self.lock:
+            return {
+                "stage": self.stage,
+                "seconds": round(time.perf_counter() - self.started, 3),
+                "counters": dict(self.counters),
+                "spans": {name: {"count": h.count, "total_seconds": round(h.sum, 3),
+                                 "mean_seconds": round(h.sum / h.count, 6) if h.count else None}
+                          for name, h in self.histograms.items()},
+            }
+
+    def prometheus(self):
+        """Counters and histograms in the Prometheus text format."""
+        prefix = f"xivv_{self.stage.replace('.', '_').replace('-', '_')}"
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+            for name, h in sorted(self.histograms.items()):
+                metric = f"{prefix}_{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), h.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f"{metric}_sum {h.sum:.6f}")
+                lines.append(f"{metric}_count {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def _flush_spans(self):
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        path = os.path.join(self.metrics_dir, f"{self.stage}.jsonl")
+        if not self.spans_written:
+            # A run starts a new file instead of appending to every run before it
+            if os.path.exists(path):
+                os.replace(path, os.path.join(self.metrics_dir, f"{self.stage}.1.jsonl"))
+            self.spans_written = True
+        with open(path, "a", encoding="utf-8") as f:
+            for line in self.span_lines:
+                f.write(line + "\n")
+        self.span_lines = []
+
+    def finish(self):
+        """End the progress line, print the span totals and write the metrics files."""
+        if self.progress_shown:
+            print()
+            self.progress_shown = False
+        summary = self.summary()
+        if summary["counters"]:
+            print(f"[{self.stage}] " + ", ".join(f"{name} {value}" for name, value in sorted(summary["counters"].items())))
+        for name, span in sorted(summary["spans"].items(), key=lambda kv: -kv[1]["total_seconds"]):
+            print(f"[{self.stage}] {name}: {span['count']} x {span['mean_seconds'] * 1000:.1f}ms = {span['total_seconds']:.1f}s")
+        if self.metrics_dir:
+            with self.lock:
+                self.span_lines.append(json.dumps(dict(summary, type="summary"), ensure_ascii=False))
+                self._flush_spans()
+            tmp_path = os.path.join(self.metrics_dir, f"{self.stage}.prom.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.prometheus())
+            os.replace(tmp_path, os.path.join(self.metrics_dir, f"{self.stage}.prom"))
+        # The next get() of this stage starts over, e.g. when a step is run twice in one process
+        if _stages.get(self.stage) is self:
+            del _stages[self.stage]
+        return summary
+
+_stages = {}
+
+def get(stage):
+    """The Metrics of a stage, created on first use. The same object is returned every
+    time, so a step's functions and pipeline.py share it."""
+    if stage not in _stages:
+        _stages[stage] = Metrics(stage, METRICS_DIR)
+    return _stages[stage]
+
+def finish_all():
+    """Finish every stage that was used, for pipeline.py which runs them all."""
+    for metrics in list(_stages.values()):
+        metrics.finish()
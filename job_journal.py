@@ -0,0 +1,165 @@
+"""SQLite journal of step 2's lines, so a run can be resumed and split across machines.
+
+Every line is a row that goes pending -> running -> done (or failed once it has failed
+MAX_ATTEMPTS times). A line is only marked done after its WAV and its JSON have both
+been written, so a crash in between leaves it running, and it's redone once its lease
+runs out instead of being skipped because the WAV exists.
+
+Several workers can share one journal, e.g. on a network share. Each line belongs to
+shard hash(line) % N, and a worker started with --shard i/N claims its own shard's lines
+first. When its shard is empty it takes pending lines from the other shards, and lines
+whose lease has expired (their worker crashed or was stopped), so the queue is drained
+even if one machine is faster or goes away. Every worker needs the same OrigData.
+
+SQLite's WAL mode doesn't work over network filesystems, so the journal uses the default
+rollback journal and short transactions.
+"""
+import os
+import time
+import socket
+import sqlite3
+import hashlib
+
+JOURNAL_PATH = "data/step2_jobs.sqlite"
+LEASE_SECONDS = 600  # A claimed line goes back to the queue if it isn't done in this time
+MAX_ATTEMPTS = 3  # Lines that fail this many times are marked failed
+
+def shard_bucket(rel_json):
+    """A stable number for a line, the same on every machine (unlike hash())."""
+    return int(hashlib.sha1(rel_json.replace("\\", "/").encode("utf-8")).hexdigest()[:8], 16)
+
+def parse_shard(text):
+    """Parse "i/N" into (i, N)."""
+    index, count = (int(part) for part in text.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"Shard {text} should be i/N with 0 <= i < N")
+    return index, count
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class JobJournal:
+    def __init__(self, path=JOURNAL_PATH, worker_id=None, shard=(0, 1), lease_seconds=LEASE_SECONDS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.worker_id = worker_id or default_worker_id()
+        self.shard = shard
+        self.lease_seconds = lease_seconds
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                rel_json TEXT PRIMARY KEY,
+                bucket INTEGER NOT NULL,
+                grp TEXT NOT NULL,
+                cache_key TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, grp)")
+
+    def _transaction(self, work):
+        """Run work(db) in one write transaction, waiting while another worker holds the lock."""
+        while True:
+            try:
+                self.db.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                time.sleep(0.5)
+        try:
+            result = work(self.db)
+            self.db.execute("COMMIT")
+            return result
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def known(self):
+        return {row[0] for row in self.db.execute("SELECT rel_json FROM jobs")}
+
+    def sync(self, jobs, already_done=()):
+        """Add the lines of this run. New lines in already_done start out done (finished
+        before the journal existed). Lines whose cache key changed (new name, nfe_step,
+        lexicon, reference...) go back to pending, the rest keep their state."""
+        now = time.time()
+        rows = [(job["rel_json"], shard_bucket(job["rel_json"]), f"{job['ref_wav_path']}|{job['speed']}", job["cache_key"],
+                 "done" if job["rel_json"] in already_done else "pending", now)
+                for job in jobs]
+        self._transaction(lambda db: db.executemany(
+            """INSERT INTO jobs (rel_json, bucket, grp, cache_key, state, updated) VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT (rel_json) DO UPDATE SET
+                   grp = excluded.grp, cache_key = excluded.cache_key, state = 'pending',
+                   worker = NULL, lease_until = NULL, attempts = 0, error = NULL, updated = excluded.updated
+               WHERE jobs.cache_key != excluded.cache_key""",
+            rows))
+
+    def retry_failed(self):
+        self._transaction(lambda db: db.execute(
+            "UPDATE jobs SET state = 'pending', attempts = 0, error = NULL WHERE state = 'failed'"))
+
+    def claim(self, count, exclude=()):
+        """Lease up to count lines to this worker: pending lines of its own shard first,
+        then pending lines of other shards, then lines whose lease expired. Lines come in
+        reference/speed order, so they batch well. Lines in exclude (e.g. ones this worker
+        doesn't have) are left for the others. Returns their relative JSON paths."""
+        now = time.time()
+        index, shards = self.shard
+
+        def work(db):
+            rows = db.execute(
+                """SELECT rel_json FROM jobs
+                   WHERE state = 'pending' OR (state = 'running' AND lease_until < ?)
+                   ORDER BY state = 'running', bucket % ? != ?, grp, rel_json LIMIT ?""",
+                (now, shards, index, count + len(exclude))).fetchall()
+            claimed = [row[0] for row in rows if row[0] not in exclude][:count]
+            db.executemany(
+                "UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, updated = ? WHERE rel_json = ?",
+                [(self.worker_id, now + self.lease_seconds, now, rel_json) for rel_json in claimed])
+            return claimed
+
+        return self._transaction(work)
+
+    def renew(self, rel_jsons):
+        """Extend the lease on lines this worker is still working on."""
+        until = time.time() + self.lease_seconds
+        self._transaction(lambda db: db.executemany(
+            "UPDATE jobs SET lease_until = ? WHERE rel_json = ? AND worker = ? AND state = 'running'",
+            [(until, rel_json, self.worker_id) for rel_json in rel_jsons]))
+
+    def release(self, rel_jsons):
+        """Give claimed lines back to the queue untouched, for another worker to take."""
+        self._transaction(lambda db: db.executemany(
+            "UPDATE jobs SET state = 'pending', worker = NULL, lease_until = NULL WHERE rel_json = ? AND worker = ?",
+            [(rel_json, self.worker_id) for rel_json in rel_jsons]))
+
+    def done(self, rel_json):
+        """Commit a line once its outputs are all in place."""
+        self._transaction(lambda db: db.execute(
+            "UPDATE jobs SET state = 'done', lease_until = NULL, error = NULL, updated = ? WHERE rel_json = ?",
+            (time.time(), rel_json)))
+
+    def failed(self, rel_json, error, final=False):
+        """Put a line back in the queue, or mark it failed after MAX_ATTEMPTS. final marks
+        it failed straight away, for lines that trying again right now won't fix."""
+        self._transaction(lambda db: db.execute(
+            """UPDATE jobs SET attempts = attempts + 1, error = ?, lease_until = NULL, updated = ?,
+                   state = CASE WHEN ? OR attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+               WHERE rel_json = ?""",
+            (str(error), time.time(), final, MAX_ATTEMPTS, rel_json)))
+
+    def others_running(self):
+        """Number of lines other workers hold a live lease on."""
+        return self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'running' AND worker != ? AND lease_until >= ?",
+            (self.worker_id, time.time())).fetchone()[0]
+
+    def counts(self):
+        return dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def close(self):
+        self.db.close()
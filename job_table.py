@@ -0,0 +1,78 @@
+"""Step 2's plan: every line it is going to generate, as a table of columns.
+
+Step 2 first works out each line's text, speed and reference without touching the model,
+then generates the rows of the table. The table is saved as a compressed NumPy .npz
+(one array per column, nothing pickled), so a plan can be looked at, sorted or compared
+without scanning OrigData or choosing references again:
+
+    rel_json    the line's JSON, relative to OrigData
+    sentence    its sentence, so the text can be worked out again for another name
+    gen_text    the text that is sent to the model
+    length      len(gen_text)
+    speed       the speed bucket
+    ref         the reference audio the line is generated from
+    ref_hash    content hash of that reference
+    cache_key   the output cache key (see output_cache.py)
+
+The name, nfe_step and reference seed it was planned with are stored alongside.
+"""
+import os
+import json
+import numpy as np
+
+PLAN_PATH = "data/step2_plan.npz"
+COLUMNS = ("rel_json", "sentence", "gen_text", "length", "speed", "ref", "ref_hash", "cache_key")
+DTYPES = {"length": np.int32, "speed": np.float64}  # Every other column is text
+
+class JobTable:
+    def __init__(self, columns, meta=None):
+        self.columns = {name: np.asarray(columns[name], dtype=DTYPES.get(name, str)) for name in COLUMNS}
+        self.meta = dict(meta or {})
+
+    def __len__(self):
+        return len(self.columns["rel_json"])
+
+    def row(self, i):
+        """One line of the plan as a dict of plain Python values."""
+        return {name: column[i].item() for name, column in self.columns.items()}
+
+    def rows(self):
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def take(self, indices):
+        """A table of the given rows (indices or a boolean mask), in that order."""
+        return JobTable({name: column[indices] for name, column in self.columns.items()}, self.meta)
+
+    def sorted(self, by):
+        """Sort by "length" (shortest first) or "reference" (lines of a reference and speed
+        together, shortest first, which is how they are batched)."""
+        if by == "length":
+            order = np.argsort(self.columns["length"], kind="stable")
+        elif by == "reference":
+            order = np.lexsort((self.columns["length"], self.columns["speed"], self.columns["ref"]))
+        else:
+            raise ValueError(f"Can't sort a plan by {by!r}")
+        return self.take(order)
+
+    def summary(self):
+        speeds, counts = np.unique(self.columns["speed"], return_counts=True)
+        return {
+            "lines": len(self),
+            "references": len(np.unique(self.columns["ref"])),
+            "characters": int(self.columns["length"].sum()),
+            "unique_outputs": len(np.unique(self.columns["cache_key"])),
+            "speeds": {float(speed): int(count) for speed, count in zip(speeds, counts)},
+        }
+
+    def save(self, path=PLAN_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, meta=np.array(json.dumps(self.meta)), **self.columns)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=PLAN_PATH):
+        with np.load(path, allow_pickle=False) as data:
+            return cls({name: data[name] for name in COLUMNS}, json.loads(data["meta"].item()))
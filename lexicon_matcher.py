@@ -0,0 +1,89 @@
+"""Compiled lexicon matcher used by step1-5-lexicon.py.
+
+Builds a character trie from the lexicon once, then finds replacements in a single
+left to right pass, so the cost per sentence depends on the sentence rather than on
+how many entries the lexicon has.
+
+The results are the same as the old regex, r'\b(?:word1|word2|...)\b' with
+re.IGNORECASE:
+- matching is case-insensitive and needs a word boundary on both ends, keys with
+  trailing spaces like "Ryne " included (the space has to be followed by a word)
+- when several keys match at the same position, the one listed first in the
+  lexicon wins, like regex alternation does, not the longest one
+- keys that only differ by case use the value of the last one
+"""
+
+_END = "\0end"  # Trie node key holding (order, replacement) for a complete lexicon key
+
+def _is_word_char(ch):
+    # Same definition as \w for str patterns
+    return ch.isalnum() or ch == "_"
+
+def _is_boundary(text, pos):
+    before = pos > 0 and _is_word_char(text[pos - 1])
+    after = pos < len(text) and _is_word_char(text[pos])
+    return before != after
+
+class LexiconMatcher:
+    """Case-insensitive whole word replacer compiled from a lexicon dict."""
+
+    def __init__(self, lexicon):
+        # Lowercase mapping exactly like the old code: the key keeps its first position,
+        # the value is the last one seen
+        case_insensitive_lexicon = {k.lower(): v for k, v in lexicon.items()}
+        self.size = len(case_insensitive_lexicon)
+        self.trie = {}
+        for order, (word, replacement) in enumerate(case_insensitive_lexicon.items()):
+            if not word:
+                continue
+            node = self.trie
+            for ch in word:
+                node = node.setdefault(ch.lower(), {})
+            node.setdefault(_END, (order, replacement))
+
+    def _match_at(self, text, start, lowered):
+        """Return (end, replacement) of the first-listed key matching at start, or None."""
+        if not _is_boundary(text, start):
+            return None
+        best = None
+        node = self.trie
+        pos = start
+        length = len(text)
+        while pos < length:
+            node = node.get(lowered[pos])
+            if node is None:
+                break
+            pos += 1
+            end = node.get(_END)
+            if end is not None and (best is None or end[0] < best[0]) and _is_boundary(text, pos):
+                best = (end[0], pos, end[1])
+        if best is None:
+            return None
+        return best[1], best[2]
+
+    def replace(self, text):
+        """Replace lexicon words in text.
+        Return the modified text and a list of (original, replacement) pairs."""
+        replacements_made = []
+        lowered = [ch.lower() for ch in text]
+        first_chars = self.trie
+        pieces = []
+        last = 0
+        pos = 0
+        length = len(text)
+        while pos < length:
+            if lowered[pos] in first_chars:
+                match = self._match_at(text, pos, lowered)
+                if match is not None:
+                    end, replacement = match
+                    original = text[pos:end]
+                    replacements_made.append((original, replacement))
+                    pieces.append(text[last:pos])
+                    pieces.append(replacement)
+                    last = pos = end
+                    continue
+            pos += 1
+        if not replacements_made:
+            return text, replacements_made
+        pieces.append(text[last:])
+        return "".join(pieces), replacements_made
@@ -0,0 +1,83 @@
+"""Encode waveforms to Opus OGG, without writing a WAV first.
+
+Step 2 uses OggEncoderPool when FUSED_OGG_OUTPUT is on: each waveform returned by the
+model is encoded on a background thread while the GPU works on the next line. Step 3
+uses encode_pcm_to_ogg() for its in-process encoder.
+
+Audio is piped into ffmpeg by default. With use_pyav it's encoded in-process with PyAV
+(pip install av) instead, which avoids starting a process per file.
+"""
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+OPUS_BITRATE = "64k"
+OPUS_SAMPLE_RATES = (48000, 24000, 16000, 12000, 8000)  # The only rates libopus accepts
+ENCODER_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+def _encode_ffmpeg(pcm, sr, ogg_path):
+    subprocess.run(
+        ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'f32le', '-ar', str(sr), '-ac', '1', '-i', 'pipe:0',
+         '-c:a', 'libopus', '-b:a', OPUS_BITRATE, ogg_path],
+        input=pcm.tobytes(),
+        check=True,
+        capture_output=True,
+    )
+
+def _encode_pyav(pcm, sr, ogg_path):
+    import av
+
+    with av.open(ogg_path, "w", format="ogg") as container:
+        stream = container.add_stream("libopus", rate=sr if sr in OPUS_SAMPLE_RATES else 48000)
+        stream.bit_rate = int(OPUS_BITRATE.rstrip("k")) * 1000
+        stream.layout = "mono"
+        frame = av.AudioFrame.from_ndarray(pcm.reshape(1, -1), format="fltp", layout="mono")
+        frame.sample_rate = sr
+        # The encoder resamples and splits the frame into Opus sized frames itself
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+
+def encode_pcm_to_ogg(wav, sr, ogg_path, use_pyav=False):
+    """Encode a float waveform to ogg_path as mono Opus. The file is written under a
+    temporary name and renamed, so a half encoded OGG never appears at ogg_path."""
+    os.makedirs(os.path.dirname(ogg_path) or ".", exist_ok=True)
+    tmp_path = ogg_path[:-len(".ogg")] + ".tmp.ogg"
+    pcm = np.asarray(wav, dtype=np.float32)
+    if pcm.ndim > 1:
+        pcm = pcm.mean(axis=1)
+    pcm = np.ascontiguousarray(pcm)
+    if use_pyav:
+        _encode_pyav(pcm, sr, tmp_path)
+    else:
+        _encode_ffmpeg(pcm, sr, tmp_path)
+    os.replace(tmp_path, ogg_path)
+    return ogg_path
+
+class OggEncoderPool:
+    """Background pool of encoders. submit() blocks once max_pending waveforms are queued,
+    so a slow disk can't make the queued audio grow without bound."""
+
+    def __init__(self, workers=ENCODER_WORKERS, max_pending=None, use_pyav=False, metrics=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.Semaphore(max_pending or workers * 4)
+        self.use_pyav = use_pyav
+        self.metrics = metrics  # An instrumentation.Metrics to record "encode" spans in
+
+    def _encode(self, wav, sr, ogg_path):
+        if self.metrics is None:
+            return encode_pcm_to_ogg(wav, sr, ogg_path, self.use_pyav)
+        with self.metrics.span("encode", ogg_path):
+            return encode_pcm_to_ogg(wav, sr, ogg_path, self.use_pyav)
+
+    def submit(self, wav, sr, ogg_path):
+        self.slots.acquire()
+        future = self.executor.submit(self._encode, wav, sr, ogg_path)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,65 @@
+"""Content addressed store of generated lines for step 2.
+
+Every generated WAV is stored under a hash of everything that went into it: the
+normalised gen_text, the reference's content hash, nfe_step, speed, seed and the name.
+Lines with identical inputs are generated once, and switching back to a name spelling
+you already tried reuses the earlier results instead of running the model again.
+
+Outputs are hardlinked out of the store where the filesystem allows it and copied
+otherwise, so nothing may write into an output file in place: write a temporary file
+and os.replace() it over the output (step 2's generate_batch() does).
+"""
+import os
+import json
+import shutil
+import hashlib
+
+OUTPUT_CACHE_DIR = "data/GenCache"
+
+def normalise_text(gen_text):
+    # Case is kept on purpose, it changes the pronunciation
+    return " ".join(gen_text.split())
+
+def cache_key(gen_text, ref_hash, nfe_step, speed, seed, name):
+    inputs = [normalise_text(gen_text), ref_hash, nfe_step, speed, seed, name]
+    return hashlib.sha1(json.dumps(inputs, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def link_or_copy(src, dest):
+    """Hardlink src to dest, or copy it if hardlinks aren't possible (e.g. across drives).
+    dest is replaced atomically."""
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    tmp_path = dest + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dest)
+
+class OutputCache:
+    def __init__(self, cache_dir=OUTPUT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key, ext=".wav"):
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def get(self, key, ext=".wav"):
+        """Return the stored file for a key, or None."""
+        path = self.path(key, ext)
+        return path if os.path.exists(path) else None
+
+    def put(self, key, src_path, ext=".wav"):
+        """Add a freshly generated file to the store."""
+        link_or_copy(src_path, self.path(key, ext))
+
+    def materialise(self, key, dest_path, ext=".wav"):
+        """Place the stored file for key at dest_path. Returns False if it isn't stored."""
+        path = self.get(key, ext)
+        if path is None:
+            return False
+        # Not touched afterwards: dest_path shares its inode with the cache entry. Step 3
+        # notices the WAV changed because its inode did.
+        link_or_copy(path, dest_path)
+        return True
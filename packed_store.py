@@ -0,0 +1,167 @@
+"""Packed version of data/OrigData: one PCM blob plus one index, instead of ~22k loose files.
+
+    data/OrigPack/index.json      every line's JSON contents, where its audio is in the
+                                  blob, its sample rate and its reference stats
+    data/OrigPack/audio-N.pcm     all clips back to back, mono 16-bit
+
+The blob is memory-mapped, so reading a clip is a slice of the map rather than opening
+and decoding a file. Step 1 writes it when PACK_OUTPUT is on, or convert an existing
+OrigData folder with:
+
+    python packed_store.py
+
+Step 1.5 and step 2 read it when their PACK_DIR is set.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import soundfile as sf
+from reference_index import analyse_audio
+
+PACK_DIR = "data/OrigPack"
+INDEX_FILE = "index.json"
+
+def to_pcm16(data):
+    """Mix to mono and convert to 16-bit PCM."""
+    data = np.asarray(data, dtype=np.float32)
+    if data.ndim > 1:
+        data = data.mean(axis=1)
+    return (np.clip(data, -1.0, 1.0) * 32767).astype(np.int16)
+
+class PackWriter:
+    """Writes a new pack next to the current one and swaps it in on close(), so readers
+    never see a half written pack."""
+
+    def __init__(self, pack_dir=PACK_DIR):
+        self.pack_dir = pack_dir
+        os.makedirs(pack_dir, exist_ok=True)
+        self.generation = self._current_generation() + 1
+        self.audio_file = f"audio-{self.generation}.pcm"
+        self.audio = open(os.path.join(pack_dir, self.audio_file), "wb")
+        self.records = {}
+        self.offset = 0  # in samples
+
+    def _current_generation(self):
+        try:
+            with open(os.path.join(self.pack_dir, INDEX_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)["generation"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return 0
+
+    def add_pcm(self, rel_json, record, pcm):
+        """Add a clip that is already mono 16-bit, e.g. copied from an older pack.
+        record needs "contents" and "samplerate", "stats" is filled in if missing."""
+        pcm = np.ascontiguousarray(pcm, dtype=np.int16)
+        record = dict(record, offset=self.offset, frames=len(pcm))
+        if "stats" not in record:
+            stats = analyse_audio(pcm.astype(np.float32) / 32768, record["samplerate"])
+            stats["sha1"] = hashlib.sha1(pcm.tobytes()).hexdigest()
+            record["stats"] = stats
+        self.audio.write(pcm.tobytes())
+        self.offset += len(pcm)
+        self.records[rel_json] = record
+
+    def add(self, rel_json, contents, data, samplerate, **extra):
+        """Add a line's JSON contents and its decoded audio."""
+        self.add_pcm(rel_json, dict(extra, contents=contents, samplerate=samplerate), to_pcm16(data))
+
+    def close(self):
+        self.audio.close()
+        index = {"generation": self.generation, "audio_file": self.audio_file, "records": self.records}
+        tmp_path = os.path.join(self.pack_dir, INDEX_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.pack_dir, INDEX_FILE))
+        # Older blobs are no longer referenced
+        for name in os.listdir(self.pack_dir):
+            if name.startswith("audio-") and name != self.audio_file:
+                try:
+                    os.remove(os.path.join(self.pack_dir, name))
+                except OSError:
+                    pass  # Still mapped by another process on Windows, removed next time
+
+class PackedStore:
+    """Read access to a pack. records maps each line's relative JSON path to its record."""
+
+    def __init__(self, pack_dir=PACK_DIR):
+        self.pack_dir = pack_dir
+        with open(os.path.join(pack_dir, INDEX_FILE), "r", encoding="utf-8") as f:
+            self.index = json.load(f)
+        self.records = self.index["records"]
+        audio_path = os.path.join(pack_dir, self.index["audio_file"])
+        if os.path.getsize(audio_path):
+            self.pcm = np.memmap(audio_path, dtype=np.int16, mode="r")
+        else:
+            self.pcm = np.zeros(0, dtype=np.int16)
+
+    @staticmethod
+    def exists(pack_dir=PACK_DIR):
+        return os.path.exists(os.path.join(pack_dir, INDEX_FILE))
+
+    def audio(self, rel_json):
+        """Return a line's clip as 16-bit PCM. This is a view into the map, nothing is copied."""
+        record = self.records[rel_json]
+        return self.pcm[record["offset"]:record["offset"] + record["frames"]]
+
+    def write_wav(self, rel_json, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        sf.write(path, self.audio(rel_json), self.records[rel_json]["samplerate"], subtype="PCM_16")
+
+    def save_index(self):
+        """Write changes to the records (e.g. step 1.5's lexicon) back to the index."""
+        tmp_path = os.path.join(self.pack_dir, INDEX_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.index, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.pack_dir, INDEX_FILE))
+
+class PackedAudio:
+    """A clip in a pack, used by step 2 in place of a reference WAV path.
+    The reference cache only writes it out as a WAV the first time it's used."""
+
+    _stores = {}  # Open packs, so each process only maps a pack once
+
+    def __init__(self, pack_dir, rel_json, sha1):
+        self.pack_dir = os.path.abspath(pack_dir)
+        self.rel_json = rel_json
+        self.sha1 = sha1
+
+    def store(self):
+        if self.pack_dir not in PackedAudio._stores:
+            PackedAudio._stores[self.pack_dir] = PackedStore(self.pack_dir)
+        return PackedAudio._stores[self.pack_dir]
+
+    def write_wav(self, path):
+        self.store().write_wav(self.rel_json, path)
+
+    def __getstate__(self):
+        # Sent to the TTS worker without the open map
+        return {"pack_dir": self.pack_dir, "rel_json": self.rel_json, "sha1": self.sha1}
+
+    def __repr__(self):
+        return f"PackedAudio({self.rel_json!r})"
+
+def build_from_dir(orig_dir, pack_dir=PACK_DIR):
+    """Pack a loose OrigData folder made by step 1."""
+    writer = PackWriter(pack_dir)
+    count = 0
+    for root, _, files in os.walk(orig_dir):
+        for file in sorted(files):
+            if not file.endswith(".json"):
+                continue
+            wav_path = os.path.join(root, file[:-len(".json")] + ".wav")
+            if not os.path.exists(wav_path):
+                continue
+            with open(os.path.join(root, file), "r", encoding="utf-8") as f:
+                contents = json.load(f)
+            data, samplerate = sf.read(wav_path, dtype="float32")
+            writer.add(os.path.relpath(os.path.join(root, file), orig_dir), contents, data, samplerate)
+            count += 1
+    writer.close()
+    return count
+
+if __name__ == "__main__":
+    orig_dir = "data/OrigData"
+    print(f"Packing {orig_dir} into {PACK_DIR}...")
+    count = build_from_dir(orig_dir, PACK_DIR)
+    print(f"Packed {count} lines. Set PACK_DIR in step 1.5 and step 2 to use it.")
@@ -0,0 +1,377 @@
+"""Run step 1, step 1.5, step 2 and step 3 as one pipeline.
+
+Every line in the source tree is an item that moves through the four stages, and each
+stage remembers a hash of the inputs it last built an item from (in STATE_PATH):
+
+    step 1     the source JSON and OGG (step 1's own manifest)
+    step 1.5   the lexicon, and the JSON step 1 wrote
+    step 2     gen_text, the reference's content hash, nfe_step, speed and the name
+               (the same key as the output cache)
+    step 3     step 2's key
+
+A stage only redoes an item whose inputs hash differs from the stored one, and because
+step 2's key is built from the text the lexicon produced, a lexicon edit only regenerates
+the lines whose text it actually changed. Stages run on their own threads and hand items
+over through queues, so step 2 starts on the first lines while step 1 is still scanning,
+and step 3 encodes lines while the GPU is busy with the next ones.
+
+The paths below replace the ones at the top of each step. The pipeline always uses the
+loose OrigData folder; PACK_OUTPUT and LAZY_DECODE are for running the steps separately.
+Other settings (name, nfe_step, batch size, backend, ...) are read from the step scripts.
+
+    python pipeline.py
+"""
+import os
+import json
+import time
+import queue
+import hashlib
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import step1_generate_newdata as step1
+import step2_generate_customdata as step2
+import step3_convert_wav_to_ogg as step3
+import instrumentation
+from deploy import deployed_stats
+from lexicon_matcher import LexiconMatcher
+from output_cache import OutputCache, link_or_copy
+from reference_index import ReferenceIndex, is_good_reference
+
+_spec = importlib.util.spec_from_file_location("step1_5_lexicon", os.path.join(os.path.dirname(os.path.abspath(__file__)), "step1-5-lexicon.py"))
+lexicon_step = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(lexicon_step)
+
+# === CONFIGURATION ===
+SOURCE_DIR = "N:/XIV_Voices/Data"
+NEW_DATA_DIR = "data/OrigData"
+ORIGINAL_OGG_DIR = "data/OriginalOggs"
+CUSTOM_DATA_DIR = "data/CustomData"
+CONVERTED_DATA_DIR = "data/FinalOggData"
+LEXICON_PATH = "lexicon.json"  # Set to None to skip step 1.5
+STATE_PATH = "data/pipeline_state.json"
+STATE_SAVE_EVERY = 500  # Save the state every N finished items in case of a crash
+QUEUE_SIZE = 256  # Items waiting between two stages, a full queue pauses the stage before it
+
+DONE = object()  # End of a stage's output
+
+def configure():
+    """Point every step at the pipeline's folders."""
+    step1.SOURCE_DIR = SOURCE_DIR
+    step1.NEW_DATA_DIR = NEW_DATA_DIR
+    step1.ORIGINAL_OGG_DIR = ORIGINAL_OGG_DIR
+    step1.PACK_OUTPUT = False
+    step1.LAZY_DECODE = False
+    lexicon_step.DIRECTORY_TO_PROCESS = NEW_DATA_DIR
+    step2.NEW_DATA_DIR = NEW_DATA_DIR
+    step2.PACK_DIR = None
+    step2.LAZY_OGG_DIR = None
+    step2.CUSTOM_DATA_DIR = CUSTOM_DATA_DIR
+    step2.CONVERTED_DATA_DIR = CONVERTED_DATA_DIR
+    step2.FUSED_OGG_OUTPUT = False  # Step 3 is a stage of its own here
+    step3.CUSTOM_DATA_DIR = CUSTOM_DATA_DIR
+    step3.CONVERTED_DATA_DIR = CONVERTED_DATA_DIR
+
+def inputs_hash(*inputs):
+    return hashlib.sha1(json.dumps(inputs, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class PipelineState:
+    """The per-item hashes from the last run, plus the ones recorded during this run.
+    Items that are no longer in the source are dropped when the run finishes."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.old = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.old = {}
+        self.new = {}
+        self.lock = threading.Lock()
+        self.changes = 0
+
+    def get(self, rel_json, stage):
+        with self.lock:
+            return self.new.get(rel_json, {}).get(stage, self.old.get(rel_json, {}).get(stage))
+
+    def set(self, rel_json, stage, value):
+        with self.lock:
+            self.new.setdefault(rel_json, {})[stage] = value
+            self.changes += 1
+            if self.changes % STATE_SAVE_EVERY == 0:
+                self._write({**self.old, **self.new})
+
+    def save(self):
+        with self.lock:
+            self._write(self.new)
+
+    def _write(self, items):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(items, f)
+        os.replace(tmp_path, self.path)
+
+def run_step1(out, stats):
+    """Stage 1: scan the source once and filter/copy/decode the new or changed lines.
+    Sends (rel_json, manifest entry) for every matched line, and ("folder", rel_dir) once
+    every line of a folder has been through, so step 2 knows its references are complete."""
+    metrics = instrumentation.get("step1")
+    manifest = step1.load_manifest(step1.MANIFEST_PATH)
+    deployed = deployed_stats(step1.DEPLOY_MANIFEST_PATH)
+    new_manifest = {}
+    pending = []
+    remaining = {}  # rel dir -> lines not through step 1 yet
+
+    for rel_json, size, mtime_ns in step1.scan_source(SOURCE_DIR):
+        remaining[os.path.dirname(rel_json)] = remaining.get(os.path.dirname(rel_json), 0) + 1
+        entry = manifest.get(rel_json)
+        if step1.is_fresh(entry, size, mtime_ns, rel_json, deployed):
+            new_manifest[rel_json] = entry
+        else:
+            pending.append((rel_json, size, mtime_ns, deployed.get(rel_json[:-len(".json")] + ".ogg")))
+
+    def finished(rel_json, entry):
+        if entry is not None:
+            new_manifest[rel_json] = entry
+            if entry["match"]:
+                out.put((rel_json, entry))
+        rel_dir = os.path.dirname(rel_json)
+        remaining[rel_dir] -= 1
+        if remaining[rel_dir] == 0:
+            out.put(("folder", rel_dir))
+
+    for rel_json, entry in list(new_manifest.items()):
+        finished(rel_json, entry)
+    stats["step1"] = len(pending)
+
+    if pending:
+        with step1.worker_pool() as pool:
+            futures = {pool.submit(step1.process_json, *job): job[0] for job in pending}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    rel_json, entry, observations = future.result()
+                    metrics.merge(observations, rel_json)
+                except Exception as e:
+                    print(f"Error processing file {futures[future]}: {e}")
+                    metrics.count("errors")
+                    rel_json, entry = futures[future], None
+                finished(rel_json, entry)
+                if done % step1.MANIFEST_SAVE_EVERY == 0:
+                    step1.save_manifest(new_manifest, step1.MANIFEST_PATH)
+
+    step1.save_manifest(new_manifest, step1.MANIFEST_PATH)
+    out.put(DONE)
+
+def run_lexicon(inp, out, state, ref_index, stats):
+    """Stage 1.5: apply the lexicon to lines it hasn't been applied to with this lexicon,
+    and index each line's WAV as a reference. Sends (rel_json, contents)."""
+    if LEXICON_PATH:
+        lexicon = lexicon_step.load_lexicon(LEXICON_PATH)
+        matcher = LexiconMatcher(lexicon)
+        lexicon_hash = inputs_hash(list(lexicon.items()))
+    else:
+        matcher = lexicon_hash = None
+    stats["lexicon"] = 0
+    metrics = instrumentation.get("lexicon")
+
+    while True:
+        item = inp.get()
+        if item is DONE:
+            break
+        if item[0] == "folder":
+            out.put(item)
+            continue
+        rel_json, entry = item
+        json_path = os.path.join(NEW_DATA_DIR, rel_json)
+        try:
+            done = state.get(rel_json, "lexicon")
+            if matcher is not None and done != [lexicon_hash, os.stat(json_path).st_mtime_ns]:
+                with metrics.span("lexicon", rel_json):
+                    modified, replacements, _ = lexicon_step.process_json_file(json_path, matcher)
+                if modified and lexicon_step.VERBOSE:
+                    lexicon_step.print_replacements(json_path, replacements)
+                metrics.count("modified" if modified else "unmodified")
+                stats["lexicon"] += 1
+            state.set(rel_json, "lexicon", [lexicon_hash, os.stat(json_path).st_mtime_ns])
+            with open(json_path, "r", encoding="utf-8") as f:
+                contents = json.load(f)
+            if entry["ogg"] is not None:
+                ref_index.update(os.path.join(NEW_DATA_DIR, rel_json[:-len(".json")] + ".wav"))
+        except Exception as e:
+            print(f"Error processing file {json_path}: {e}")
+            continue
+        out.put((rel_json, contents))
+    ref_index.save()
+    out.put(DONE)
+
+class Step2Stage:
+    """Stage 2: turn lines into jobs, generate the ones whose key changed and hand every
+    finished WAV to the step 3 pool. Lines are batched per reference and speed as in step 2."""
+
+    def __init__(self, state, ref_index, encoder, stats):
+        self.state = state
+        self.ref_index = ref_index
+        self.encoder = encoder
+        self.stats = stats
+        self.output_cache = OutputCache(step2.OUTPUT_CACHE_DIR) if step2.OUTPUT_CACHE_DIR else None
+        self.tts = None  # Only loaded once something needs generating
+        self.held = {}  # rel dir -> lines waiting for the folder's references
+        self.groups = {}  # (reference, speed) -> jobs waiting to fill a batch
+        self.waiting = {}  # cache key -> duplicates of a line being generated, see step2.dedupe_jobs()
+        self.generated = {}  # cache key -> the line generated for it in this run, for later duplicates
+        self.jobs = {}  # output path -> rel_json
+        self.futures = []
+        stats["step2"] = stats["step3"] = stats["step2_failed"] = 0
+
+    def run(self, inp):
+        while True:
+            item = inp.get()
+            if item is DONE:
+                break
+            if item[0] == "folder":
+                for rel_json, contents in self.held.pop(item[1], []):
+                    self.add(rel_json, contents)
+                continue
+            rel_json, contents = item
+            own_wav = os.path.join(NEW_DATA_DIR, rel_json[:-len(".json")] + ".wav")
+            own_stats = self.ref_index.stats(own_wav)
+            if own_stats is not None and is_good_reference(own_stats):
+                self.add(rel_json, contents)
+            else:
+                # Needs another reference from the folder, which may not all be here yet
+                self.held.setdefault(os.path.dirname(rel_json), []).append((rel_json, contents))
+        for lines in self.held.values():
+            for rel_json, contents in lines:
+                self.add(rel_json, contents)
+        # Failed batches put their duplicates back into groups, so keep going until it's empty
+        while self.groups:
+            self.generate(self.groups.pop(next(iter(self.groups))))
+
+    def add(self, rel_json, contents):
+        job = step2.make_job(rel_json, contents, self.ref_index)
+        if job is None:
+            return
+        key = job["cache_key"]
+        self.jobs[job["output_path"]] = rel_json
+        if self.state.get(rel_json, "step2") == key and os.path.exists(job["output_path"]):
+            self.state.set(rel_json, "step2", key)
+            self.to_step3(job)
+        elif self.output_cache is not None and self.output_cache.get(key) is not None:
+            self.output_cache.materialise(key, job["output_path"])
+            step2.finish_job(job)
+            self.record(job)
+        elif key in self.generated:
+            self.hand_on(self.generated[key], job)
+        elif key in self.waiting:
+            self.waiting[key].append(job)
+        else:
+            self.waiting[key] = []
+            self.queue(job)
+
+    def queue(self, job):
+        group = self.groups.setdefault((job["ref_wav_path"], job["speed"]), [])
+        group.append(job)
+        if len(group) >= step2.BATCH_SIZE:
+            self.generate(self.groups.pop((job["ref_wav_path"], job["speed"])))
+
+    def generate(self, batch):
+        metrics = instrumentation.get("step2")
+        if self.tts is None:
+            with metrics.span("load_model"):
+                self.tts = step2.get_tts()
+        start = time.perf_counter()
+        try:
+            results = step2.generate_batch(self.tts, batch)
+        except Exception as e:
+            print(f"Generation failed for {', '.join(job['file'] for job in batch)}: {e}")
+            metrics.count("failed", len(batch))
+            self.stats["step2_failed"] += len(batch)
+            for job in batch:
+                # The first duplicate takes the failed line's place, the others wait on it
+                duplicates = self.waiting.pop(step2.planned_key(job), [])
+                if duplicates:
+                    self.waiting[step2.planned_key(job)] = duplicates[1:]
+                    self.queue(duplicates[0])
+            return
+        elapsed = time.perf_counter() - start
+        for job in batch:
+            metrics.observe("infer", elapsed / len(batch), self.jobs[job["output_path"]])
+        metrics.count("generated", len(batch))
+        passed, retries = step2.gate_results(batch, results, self.ref_index)
+        for job, _, _ in passed:
+            key = step2.planned_key(job)
+            duplicates = self.waiting.pop(key)
+            step2.complete_job(job, {key: duplicates}, self.output_cache)
+            self.generated[key] = {"output_path": job["output_path"], "quality_problems": job.get("quality_problems")}
+            for finished_job in [job] + duplicates:
+                self.record(finished_job)
+        metrics.progress(self.stats["step2"])
+        for retry in step2.make_batches(retries, step2.BATCH_SIZE):
+            self.generate(retry)
+
+    def hand_on(self, source, job):
+        """Give a line the audio of an identical one that was already generated."""
+        link_or_copy(source["output_path"], job["output_path"])
+        job["quality_problems"] = source.get("quality_problems")
+        step2.finish_job(job)
+        self.record(job)
+
+    def record(self, job):
+        """Count a finished line and pass it on to step 3. Lines that still fail the quality
+        gate aren't recorded in the state, so they're generated again next run."""
+        self.stats["step2"] += 1
+        if not job.get("quality_problems"):
+            self.state.set(self.jobs[job["output_path"]], "step2", step2.planned_key(job))
+        self.to_step3(job)
+
+    def to_step3(self, job):
+        rel_json = self.jobs[job["output_path"]]
+        ogg_path = job["output_path"].replace(CUSTOM_DATA_DIR, CONVERTED_DATA_DIR, 1)[:-len(".wav")] + ".ogg"
+        key = step2.planned_key(job)
+        if self.state.get(rel_json, "step3") == key and os.path.exists(ogg_path):
+            self.state.set(rel_json, "step3", key)
+            return
+        future = self.encoder.submit(step3.timed_conversion, instrumentation.get("step3"), job["output_path"], ogg_path)
+        self.futures.append((future, rel_json, key))
+
+    def wait_for_step3(self):
+        for future, rel_json, key in self.futures:
+            if future.result():
+                self.state.set(rel_json, "step3", key)
+                self.stats["step3"] += 1
+                instrumentation.get("step3").count("converted")
+            else:
+                print(f"Step 3 failed for {rel_json}, see {step3.LOG_FILE}")
+
+def run_pipeline():
+    configure()
+    state = PipelineState(STATE_PATH)
+    ref_index = ReferenceIndex(NEW_DATA_DIR, step2.REF_INDEX_PATH)
+    stats = {}
+    scanned = queue.Queue(QUEUE_SIZE)
+    prepared = queue.Queue(QUEUE_SIZE)
+
+    threads = [
+        threading.Thread(target=run_step1, args=(scanned, stats), daemon=True),
+        threading.Thread(target=run_lexicon, args=(scanned, prepared, state, ref_index, stats), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    with ThreadPoolExecutor(max_workers=step3.WORKERS) as encoder:
+        stage2 = Step2Stage(state, ref_index, encoder, stats)
+        stage2.run(prepared)
+        stage2.wait_for_step3()
+    for thread in threads:
+        thread.join()
+
+    state.save()
+    instrumentation.finish_all()
+    print(f"Finished: step 1 processed {stats['step1']} files, step 1.5 {stats['lexicon']}, "
+          f"step 2 {stats['step2']}, step 3 {stats['step3']}. Everything else was up to date.")
+    if stats["step2_failed"]:
+        print(f"{stats['step2_failed']} lines failed to generate in step 2, they're tried again next run.")
+
+if __name__ == "__main__":
+    step3.setup_logging()
+    run_pipeline()
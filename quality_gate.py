@@ -0,0 +1,71 @@
+"""Automatic checks on every line step 2 generates, so broken ones are redone without
+having to listen to all of them.
+
+A line fails if:
+- it is much shorter or longer than its text should take at its speed (cut off, or
+  rambling on after the sentence)
+- it starts or ends with a long silence
+- it clips
+- it is much louder or quieter than its reference
+
+With QUALITY_GATE = True, step 2 generates failing lines again, first with a new seed and then with another
+reference from the same speaker, up to MAX_RETRIES times. Lines that still fail are kept
+but not cached, and their problems are written into their JSON under "quality_problems".
+"""
+import numpy as np
+from reference_index import SILENCE_DB
+
+CHARS_PER_SECOND = 14.0  # Rough speaking rate of F5-TTS at speed 1.0
+MIN_DURATION_RATIO = 0.4  # Allowed range of actual / expected duration
+MAX_DURATION_RATIO = 2.5
+MAX_LEADING_SILENCE = 0.75  # Seconds
+MAX_TRAILING_SILENCE = 1.5
+CLIP_LEVEL = 0.99  # Samples at or above this are clipped
+MAX_CLIPPED_RATIO = 0.001
+MAX_LOUDNESS_DIFF_DB = 12.0  # Allowed RMS difference to the reference
+MAX_RETRIES = 2  # Retry with a new seed first, then with another reference
+
+def to_db(rms):
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+def frame_rms(mono, samplerate):
+    """RMS of every 20ms frame."""
+    frame = max(1, samplerate // 50)
+    usable = len(mono) // frame * frame
+    return np.sqrt(np.mean(mono[:usable].reshape(-1, frame) ** 2, axis=1)), frame / samplerate
+
+def expected_duration(gen_text, speed):
+    return len(gen_text.strip(" .")) / CHARS_PER_SECOND / speed
+
+def check(wav, samplerate, gen_text, speed, ref_rms=None):
+    """Return the problems found in a generated line, an empty list if it's fine."""
+    mono = np.asarray(wav, dtype=np.float32)
+    if mono.ndim > 1:
+        mono = mono.mean(axis=1)
+    levels, frame_seconds = frame_rms(mono, samplerate)
+    voiced = np.flatnonzero(levels >= 10 ** (SILENCE_DB / 20))
+    if not len(voiced):
+        return ["silent"]
+
+    problems = []
+    duration = len(mono) / samplerate
+    ratio = duration / max(expected_duration(gen_text, speed), frame_seconds)
+    if not MIN_DURATION_RATIO <= ratio <= MAX_DURATION_RATIO:
+        problems.append(f"duration {duration:.1f}s is {ratio:.1f}x the expected length")
+
+    leading = voiced[0] * frame_seconds
+    trailing = (len(levels) - 1 - voiced[-1]) * frame_seconds
+    if leading > MAX_LEADING_SILENCE:
+        problems.append(f"{leading:.1f}s of silence at the start")
+    if trailing > MAX_TRAILING_SILENCE:
+        problems.append(f"{trailing:.1f}s of silence at the end")
+
+    clipped = np.count_nonzero(np.abs(mono) >= CLIP_LEVEL) / len(mono)
+    if clipped > MAX_CLIPPED_RATIO:
+        problems.append(f"{clipped:.2%} of samples clipped")
+
+    if ref_rms:
+        difference = float(to_db(np.sqrt(np.mean(mono ** 2))) - to_db(ref_rms))
+        if abs(difference) > MAX_LOUDNESS_DIFF_DB:
+            problems.append(f"{difference:+.0f} dB compared to the reference")
+    return problems
@@ -0,0 +1,131 @@
+"""Cache of preprocessed reference audio and transcripts for step 2.
+
+Step 2 calls infer() with an empty ref_text, so every call would have F5-TTS transcribe
+the reference again and resample it, even though thousands of lines share the same
+reference. This keeps the preprocessed reference (clipped, mono, at the model's sample
+rate) and its transcript on disk, keyed by the content hash of the reference file, and
+evicts the least recently used entries once it holds more than max_entries.
+"""
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+REF_CACHE_MAX_ENTRIES = 1000  # ~0.5MB per entry
+
+def f5_preprocess_reference(tts, ref_file, out_path):
+    """Run F5-TTS's own reference preprocessing (clipping + transcription), then save the
+    result mono at the model's sample rate so it doesn't get resampled on every call.
+    Returns the transcript."""
+    import torchaudio
+    from f5_tts.infer.utils_infer import preprocess_ref_audio_text
+
+    processed_path, ref_text = preprocess_ref_audio_text(ref_file, "")
+    audio, sr = torchaudio.load(processed_path)
+    if audio.shape[0] > 1:
+        audio = audio.mean(dim=0, keepdim=True)
+    if sr != tts.target_sample_rate:
+        audio = torchaudio.transforms.Resample(sr, tts.target_sample_rate)(audio)
+    torchaudio.save(out_path, audio, tts.target_sample_rate)
+    return ref_text
+
+class ReferenceCache:
+    def __init__(self, cache_dir, preprocess, max_entries=REF_CACHE_MAX_ENTRIES):
+        """preprocess(ref_file, out_path) writes the processed reference to out_path and
+        returns its transcript."""
+        self.cache_dir = cache_dir
+        self.preprocess = preprocess
+        self.max_entries = max_entries
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.hashes = {}  # (path, size, mtime_ns) -> content hash, so files are only hashed once per run
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                # Stored least recently used first
+                self.entries = OrderedDict(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = OrderedDict()
+
+    def content_hash(self, ref_file):
+        if not isinstance(ref_file, str):
+            # A clip in a pack (packed_store.PackedAudio) already knows its hash
+            return ref_file.sha1
+        st = os.stat(ref_file)
+        stat_key = (os.path.abspath(ref_file), st.st_size, st.st_mtime_ns)
+        if stat_key not in self.hashes:
+            h = hashlib.sha1()
+            with open(ref_file, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(chunk)
+            self.hashes[stat_key] = h.hexdigest()
+        return self.hashes[stat_key]
+
+    def get(self, ref_file):
+        """Return (processed reference path, transcript) for a reference file path or a
+        packed_store.PackedAudio clip."""
+        key = self.content_hash(ref_file)
+        entry = self.entries.get(key)
+        if entry is not None:
+            cached_path = os.path.join(self.cache_dir, entry["file"])
+            if os.path.exists(cached_path):
+                self.hits += 1
+                self.entries.move_to_end(key)
+                # Keep the LRU order on disk roughly up to date without rewriting it every call
+                if self.hits % 100 == 0:
+                    self.save()
+                return cached_path, entry["text"]
+
+        self.misses += 1
+        cached_path = os.path.join(self.cache_dir, key + ".wav")
+        if isinstance(ref_file, str):
+            ref_text = self.preprocess(ref_file, cached_path)
+        else:
+            # Only now does a packed clip need to exist as a file
+            source_path = os.path.join(self.cache_dir, key + ".source.wav")
+            ref_file.write_wav(source_path)
+            try:
+                ref_text = self.preprocess(source_path, cached_path)
+            finally:
+                os.remove(source_path)
+        self.entries[key] = {"file": key + ".wav", "text": ref_text}
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            _, evicted = self.entries.popitem(last=False)
+            try:
+                os.remove(os.path.join(self.cache_dir, evicted["file"]))
+            except FileNotFoundError:
+                pass
+        self.save()
+        return cached_path, ref_text
+
+    def save(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(list(self.entries.items()), f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+class CachedReferenceTTS:
+    """Wraps a TTS backend so calls with an empty ref_text use the reference cache."""
+
+    def __init__(self, backend, cache_dir, max_entries=REF_CACHE_MAX_ENTRIES):
+        self.backend = backend
+        if hasattr(backend, "preprocess_reference"):
+            preprocess = backend.preprocess_reference
+        else:
+            preprocess = lambda ref_file, out_path: f5_preprocess_reference(backend, ref_file, out_path)
+        self.cache = ReferenceCache(cache_dir, preprocess, max_entries)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def infer(self, ref_file, ref_text, gen_text, **kwargs):
+        if not ref_text:
+            ref_file, ref_text = self.cache.get(ref_file)
+        return self.backend.infer(ref_file=ref_file, ref_text=ref_text, gen_text=gen_text, **kwargs)
+
+    def infer_batch(self, ref_file, ref_text, gen_texts, **kwargs):
+        if not ref_text:
+            ref_file, ref_text = self.cache.get(ref_file)
+        return self.backend.infer_batch(ref_file=ref_file, ref_text=ref_text, gen_texts=gen_texts, **kwargs)
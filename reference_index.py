@@ -0,0 +1,222 @@
+"""Per-speaker index of reference WAVs for step 2.
+
+Scans data/OrigData once per run and records every WAV's duration, sample rate, RMS,
+silence ratio and content hash per speaker folder. The results are kept in
+data/reference_index.json, so only new or changed WAVs are read on the next run. Step 2
+then picks references from the precomputed candidates of the folder, instead of listing
+the folder and statting every file for every line, and the pick is seeded so a run can
+be reproduced.
+"""
+import io
+import os
+import json
+import random
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import soundfile as sf
+
+REF_INDEX_PATH = "data/reference_index.json"
+MIN_REF_SECONDS = 3.0  # Lines shorter than this get a longer reference from the same speaker
+MIN_REF_RMS = 0.005  # Ignore near silent references
+MAX_SILENCE_RATIO = 0.5  # Ignore references that are mostly silence
+SILENCE_DB = -40  # 20ms frames below this (dBFS) count as silence
+WORKERS = os.cpu_count() or 1
+
+def analyse_audio(mono, samplerate):
+    """Return the stats of a mono float waveform (without the content hash)."""
+    frame = max(1, samplerate // 50)
+    usable = len(mono) // frame * frame
+    if usable:
+        frame_rms = np.sqrt(np.mean(mono[:usable].reshape(-1, frame) ** 2, axis=1))
+        silence_ratio = float(np.mean(frame_rms < 10 ** (SILENCE_DB / 20)))
+    else:
+        silence_ratio = 1.0
+
+    return {
+        "duration": len(mono) / samplerate,
+        "samplerate": samplerate,
+        "rms": float(np.sqrt(np.mean(mono ** 2))) if len(mono) else 0.0,
+        "silence_ratio": silence_ratio,
+    }
+
+def analyse_wav(path):
+    """Read a WAV once and return its stats."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    data, samplerate = sf.read(io.BytesIO(raw), dtype="float32", always_2d=True)
+    entry = analyse_audio(data.mean(axis=1), samplerate)
+    entry["sha1"] = hashlib.sha1(raw).hexdigest()
+    return entry
+
+def analyse_header(path):
+    """Stats from the file header only, for OGGs that shouldn't be decoded yet.
+    rms and silence_ratio are unknown (None) and pass is_good_reference()."""
+    info = sf.info(path)
+    with open(path, "rb") as f:
+        sha1 = hashlib.sha1(f.read()).hexdigest()
+    return {"duration": info.duration, "samplerate": info.samplerate, "rms": None, "silence_ratio": None, "sha1": sha1}
+
+def _analyse_job(job):
+    rel_dir, name, path, size, mtime_ns, full_analysis = job
+    try:
+        entry = analyse_wav(path) if full_analysis else analyse_header(path)
+    except Exception as e:
+        print(f"Could not analyse {path}: {e}")
+        return rel_dir, name, None
+    entry["size"] = size
+    entry["mtime_ns"] = mtime_ns
+    return rel_dir, name, entry
+
+def is_good_reference(entry):
+    return (entry["duration"] >= MIN_REF_SECONDS
+            and (entry["rms"] is None or entry["rms"] >= MIN_REF_RMS)
+            and (entry["silence_ratio"] is None or entry["silence_ratio"] <= MAX_SILENCE_RATIO))
+
+class ReferenceIndex:
+    """With ext=".ogg" and full_analysis=False it indexes the original OGGs from their
+    headers, without decoding them (step 2's LAZY_OGG_DIR)."""
+
+    def __init__(self, data_dir, index_path=REF_INDEX_PATH, ext=".wav", full_analysis=True):
+        self.data_dir = data_dir
+        self.index_path = index_path
+        self.ext = ext
+        self.full_analysis = full_analysis
+        self.dirs = {}  # rel dir -> {wav name -> stats}
+        self.saved = None  # The index from the last run, loaded by update()
+        self.candidates = {}  # rel dir -> sorted names of good references
+        self.longest = {}  # rel dir -> name of the longest WAV
+
+    def load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        if saved.get("data_dir") != os.path.abspath(self.data_dir) or saved.get("full_analysis", True) != self.full_analysis:
+            return {}
+        return saved["dirs"]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"data_dir": os.path.abspath(self.data_dir), "full_analysis": self.full_analysis, "dirs": self.dirs}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def build(self):
+        """Scan the data folder, analyse new or changed files and save the index."""
+        saved = self.load()
+        self.dirs = {}
+        jobs = []
+        stack = [self.data_dir]
+        while stack:
+            current = stack.pop()
+            rel_dir = os.path.relpath(current, self.data_dir)
+            known = saved.get(rel_dir, {})
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(self.ext):
+                        st = entry.stat()
+                        old = known.get(entry.name)
+                        if old is not None and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+                            self.dirs.setdefault(rel_dir, {})[entry.name] = old
+                        else:
+                            jobs.append((rel_dir, entry.name, entry.path, st.st_size, st.st_mtime_ns, self.full_analysis))
+
+        if jobs:
+            print(f"Analysing {len(jobs)} new or changed reference files...")
+            with ProcessPoolExecutor(max_workers=WORKERS) as pool:
+                for rel_dir, name, entry in pool.map(_analyse_job, jobs, chunksize=32):
+                    if entry is not None:
+                        self.dirs.setdefault(rel_dir, {})[name] = entry
+            self.save()
+        elif self.dirs != saved:
+            # Files were removed
+            self.save()
+
+        self._precompute()
+        return self
+
+    def load_pack(self, pack):
+        """Fill the index from a PackedStore, whose records already carry their stats.
+        WAV paths are then virtual paths under data_dir."""
+        self.dirs = {}
+        for rel_json, record in pack.records.items():
+            rel_dir, name = os.path.split(rel_json[:-len(".json")] + ".wav")
+            self.dirs.setdefault(rel_dir or ".", {})[name] = record["stats"]
+        self._precompute()
+        return self
+
+    def update(self, path):
+        """Add or refresh a single file, for callers that get files one at a time instead of
+        scanning the folder (pipeline.py). Returns its stats, or None if it can't be read.
+        Call save() once done."""
+        if self.saved is None:
+            self.saved = self.load()
+        rel_dir, name = os.path.split(os.path.relpath(path, self.data_dir))
+        rel_dir = rel_dir or "."
+        st = os.stat(path)
+        entry = self.saved.get(rel_dir, {}).get(name)
+        if entry is None or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+            entry = _analyse_job((rel_dir, name, path, st.st_size, st.st_mtime_ns, self.full_analysis))[2]
+            if entry is None:
+                return None
+        self.dirs.setdefault(rel_dir, {})[name] = entry
+        self._precompute_dir(rel_dir)
+        return entry
+
+    def _precompute(self):
+        self.candidates = {}
+        self.longest = {}
+        for rel_dir in self.dirs:
+            self._precompute_dir(rel_dir)
+
+    def _precompute_dir(self, rel_dir):
+        wavs = self.dirs[rel_dir]
+        self.candidates[rel_dir] = sorted(name for name, entry in wavs.items() if is_good_reference(entry))
+        self.longest[rel_dir] = max(wavs, key=lambda name: wavs[name]["duration"])
+
+    def stats(self, wav_path):
+        """Return the indexed stats of a WAV, or None if it isn't in the index."""
+        rel_dir, name = os.path.split(os.path.relpath(wav_path, self.data_dir))
+        return self.dirs.get(rel_dir or ".", {}).get(name)
+
+    def choose(self, original_wav_path, seed=0):
+        """Pick a reference for a line:
+        - the line's own WAV if it's a good reference
+        - otherwise a good reference from the same speaker folder, chosen with a random
+          generator seeded by the seed and the line, so reruns pick the same one
+        - otherwise the longest WAV in the folder
+        """
+        rel_path = os.path.relpath(original_wav_path, self.data_dir)
+        rel_dir, name = os.path.split(rel_path)
+        rel_dir = rel_dir or "."
+        entry = self.dirs.get(rel_dir, {}).get(name)
+        if entry is not None and is_good_reference(entry):
+            return original_wav_path
+
+        candidates = self.candidates.get(rel_dir)
+        if candidates:
+            # Seeded with the path as on Linux, so Windows picks the same reference
+            chosen = random.Random(f"{seed}:{rel_path.replace(os.sep, '/')}").choice(candidates)
+            return os.path.join(self.data_dir, rel_dir, chosen)
+
+        longest = self.longest.get(rel_dir)
+        if longest is not None:
+            return os.path.join(self.data_dir, rel_dir, longest)
+        return original_wav_path
+
+    def choose_other(self, original_wav_path, avoid, seed=0):
+        """Pick a good reference from the line's speaker folder that isn't one of the paths
+        in avoid, e.g. to generate a line again after a bad result. None if there's none."""
+        rel_path = os.path.relpath(original_wav_path, self.data_dir)
+        rel_dir = os.path.dirname(rel_path) or "."
+        avoid = {os.path.normpath(path) for path in avoid}
+        others = [name for name in self.candidates.get(rel_dir, [])
+                  if os.path.normpath(os.path.join(self.data_dir, rel_dir, name)) not in avoid]
+        if not others:
+            return None
+        return os.path.join(self.data_dir, rel_dir, random.Random(f"{seed}:{rel_path.replace(os.sep, '/')}").choice(others))
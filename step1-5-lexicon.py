@@ -1,10 +1,18 @@
 import os
 import json
 import re
+import instrumentation
+from lexicon_matcher import LexiconMatcher
+from packed_store import PackedStore
 
 # Configuration - Hard-coded values
 DIRECTORY_TO_PROCESS = "data/OrigData"  # Change this to your directory path
 LEXICON_PATH = "lexicon.json"  # Path to your lexicon file
+INDEX_PATH = "data/lexicon_index.json"  # Word -> files index used to only reprocess what a lexicon edit touches
+PRISTINE_KEY = "original_sentence"  # The untouched sentence is kept under this key so the lexicon is never applied twice
+WORD_PATTERN = re.compile(r"\w+")
+PACK_DIR = None  # Set to "data/OrigPack" to update a pack made by step 1 instead of the folder
+VERBOSE = False  # Print every replacement made instead of a progress line
 
 def load_lexicon(lexicon_path):
     """Load the lexicon file containing word replacements."""
@@ -18,33 +26,46 @@ def load_lexicon(lexicon_path):
         print(f"Error: Lexicon file '{lexicon_path}' is not valid JSON.")
         exit(1)
 
-def replace_words_in_text(text, lexicon):
+def replace_words_in_text(text, matcher):
     """Replace whole words in text according to the lexicon (case-insensitive). 
     Return the modified text and a list of replacements made."""
     if not isinstance(text, str):
         return text, []
     
-    replacements_made = []
-    
-    # Create a dictionary mapping lowercase words to their replacements
-    # This is to handle case-insensitive matching
-    case_insensitive_lexicon = {k.lower(): v for k, v in lexicon.items()}
-    
-    # Create a pattern that matches whole words only (case-insensitive)
-    pattern = r'\b(?:' + '|'.join(re.escape(word) for word in case_insensitive_lexicon.keys()) + r')\b'
-    
-    def replace_match(match):
-        original = match.group(0)
-        replacement = case_insensitive_lexicon[original.lower()]
-        replacements_made.append((original, replacement))
-        return replacement
-    
-    # Use re.IGNORECASE flag for case-insensitive matching
-    modified_text = re.sub(pattern, replace_match, text, flags=re.IGNORECASE)
-    return modified_text, replacements_made
+    return matcher.replace(text)
+
+def apply_to_sentence(data, matcher):
+    """Apply the lexicon to data['sentence'], always starting from the pristine sentence.
+    The pristine copy is stored the first time the sentence changes."""
+    pristine = data.get(PRISTINE_KEY, data['sentence'])
+    if not isinstance(pristine, str):
+        pristine = data['sentence']
+    new_sentence, replacements = replace_words_in_text(pristine, matcher)
+    modified = new_sentence != data['sentence']
+    data['sentence'] = new_sentence
+    if new_sentence != pristine and PRISTINE_KEY not in data:
+        data[PRISTINE_KEY] = pristine
+        modified = True
+    return modified, replacements
+
+def sentence_words(data):
+    """Return the set of lowercase words in all pristine sentences of a JSON document."""
+    words = set()
+    if isinstance(data, dict):
+        if 'sentence' in data and isinstance(data['sentence'], str):
+            pristine = data.get(PRISTINE_KEY, data['sentence'])
+            if isinstance(pristine, str):
+                words.update(word.lower() for word in WORD_PATTERN.findall(pristine))
+        for value in data.values():
+            words |= sentence_words(value)
+    elif isinstance(data, list):
+        for item in data:
+            words |= sentence_words(item)
+    return words
 
-def process_json_file(filepath, lexicon):
-    """Process a JSON file, replacing words in the 'sentence' field."""
+def process_json_file(filepath, matcher):
+    """Process a JSON file, replacing words in the 'sentence' field.
+    Returns whether it was modified, the replacements made and the words in its sentences."""
     try:
         with open(filepath, 'r', encoding='utf-8') as file:
             data = json.load(file)
@@ -55,105 +76,217 @@ def process_json_file(filepath, lexicon):
         # If data is a dictionary and has a 'sentence' key
         if isinstance(data, dict):
             if 'sentence' in data and isinstance(data['sentence'], str):
-                original = data['sentence']
-                data['sentence'], replacements = replace_words_in_text(data['sentence'], lexicon)
+                modified, replacements = apply_to_sentence(data, matcher)
                 all_replacements.extend(replacements)
-                modified = original != data['sentence']
             # Process nested dictionaries and lists
             for key, value in data.items():
                 if isinstance(value, (dict, list)):
-                    data[key], sub_modified, sub_replacements = process_nested_json(value, lexicon)
+                    data[key], sub_modified, sub_replacements = process_nested_json(value, matcher)
                     all_replacements.extend(sub_replacements)
                     modified = modified or sub_modified
         
         # If data is a list, process each element
         elif isinstance(data, list):
-            data, modified, nested_replacements = process_nested_json(data, lexicon)
+            data, modified, nested_replacements = process_nested_json(data, matcher)
             all_replacements.extend(nested_replacements)
         
+        words = sentence_words(data)
         if modified:
             with open(filepath, 'w', encoding='utf-8') as file:
                 json.dump(data, file, indent=2, ensure_ascii=False)
-            return True, all_replacements
-        return False, []
+            return True, all_replacements, words
+        return False, [], words
     
     except (json.JSONDecodeError, FileNotFoundError) as e:
         print(f"Error processing file {filepath}: {e}")
-        return False, []
+        return False, [], set()
 
-def process_nested_json(data, lexicon):
+def process_nested_json(data, matcher):
     """Process nested dictionaries and lists in JSON data."""
     modified = False
     all_replacements = []
     
     if isinstance(data, dict):
         if 'sentence' in data and isinstance(data['sentence'], str):
-            original = data['sentence']
-            data['sentence'], replacements = replace_words_in_text(data['sentence'], lexicon)
+            modified, replacements = apply_to_sentence(data, matcher)
             all_replacements.extend(replacements)
-            modified = original != data['sentence']
         
         for key, value in list(data.items()):
             if isinstance(value, (dict, list)):
-                data[key], sub_modified, sub_replacements = process_nested_json(value, lexicon)
+                data[key], sub_modified, sub_replacements = process_nested_json(value, matcher)
                 all_replacements.extend(sub_replacements)
                 modified = modified or sub_modified
     
     elif isinstance(data, list):
         for i, item in enumerate(data):
             if isinstance(item, (dict, list)):
-                data[i], sub_modified, sub_replacements = process_nested_json(item, lexicon)
+                data[i], sub_modified, sub_replacements = process_nested_json(item, matcher)
                 all_replacements.extend(sub_replacements)
                 modified = modified or sub_modified
             elif isinstance(item, str) and 'sentence' in data and data.index(item) == data.index('sentence') + 1:
                 # This assumes a pattern where 'sentence' might be a key in a list followed by its value
                 original = item
-                data[i], replacements = replace_words_in_text(item, lexicon)
+                data[i], replacements = replace_words_in_text(item, matcher)
                 all_replacements.extend(replacements)
                 modified = original != data[i]
     
     return data, modified, all_replacements
 
-def process_directory(directory, lexicon):
-    """Process all JSON files in the specified directory and its subdirectories."""
+def load_index(index_path):
+    """Load the word index from the last run. Returns None if there isn't a usable one."""
+    try:
+        with open(index_path, 'r', encoding='utf-8') as file:
+            index = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    # Build the inverted index, word -> files containing it
+    index["words"] = {}
+    for rel_path, entry in index["files"].items():
+        for word in entry["words"]:
+            index["words"].setdefault(word, set()).add(rel_path)
+    return index
+
+def save_index(index, index_path):
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump({"lexicon": index["lexicon"], "files": index["files"]}, file, ensure_ascii=False)
+    os.replace(tmp_path, index_path)
+
+def lexicon_changes(old_lexicon, new_lexicon):
+    """Return the lowercase keys that were added, removed or changed between two lexicons,
+    or None if the order of existing keys changed (which can change which key wins)."""
+    old_keys = [key for key in old_lexicon if key in new_lexicon]
+    new_keys = [key for key in new_lexicon if key in old_lexicon]
+    if old_keys != new_keys:
+        return None
+    return {key for key in set(old_lexicon) | set(new_lexicon) if old_lexicon.get(key) != new_lexicon.get(key)}
+
+def wordless_keys(changed_keys):
+    """The changed keys with no words to look up in the index, e.g. punctuation only."""
+    return sorted(key for key in changed_keys if not WORD_PATTERN.findall(key))
+
+def files_affected_by(changed_keys, index):
+    """Use the inverted index to find files whose sentences contain every word of a changed key.
+    Every key must have words, see wordless_keys()."""
+    affected = set()
+    for key in changed_keys:
+        key_words = [word.lower() for word in WORD_PATTERN.findall(key)]
+        postings = [index["words"].get(word, set()) for word in key_words]
+        affected |= set.intersection(*postings)
+    return affected
+
+def scan_json_files(directory):
+    """Return {relative path: mtime_ns} for every JSON in directory."""
+    found = {}
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith('.json') and entry.name != os.path.basename(LEXICON_PATH):
+                    found[os.path.relpath(entry.path, directory)] = entry.stat().st_mtime_ns
+    return found
+
+def print_replacements(file_path, replacements):
+    print(f"\nModified: {file_path}")
+    
+    # Group replacements by original word for cleaner output
+    replacement_counts = {}
+    for orig, repl in replacements:
+        if (orig, repl) not in replacement_counts:
+            replacement_counts[(orig, repl)] = 1
+        else:
+            replacement_counts[(orig, repl)] += 1
+    
+    # Print the replacements made in this file
+    for (orig, repl), count in replacement_counts.items():
+        print(f"  - Replaced '{orig}' with '{repl}' ({count} times)")
+
+def process_pack(pack_dir, matcher):
+    """Apply the lexicon to the sentences in a pack's index (see packed_store.py).
+    It's all in memory, so every line is redone; that's quicker than the file index."""
+    metrics = instrumentation.get("lexicon")
+    pack = PackedStore(pack_dir)
+    modified_count = 0
+    
+    for rel_path, record in pack.records.items():
+        with metrics.span("lexicon", rel_path):
+            record["contents"], modified, replacements = process_nested_json(record["contents"], matcher)
+        if modified:
+            modified_count += 1
+            metrics.count("modified")
+            if VERBOSE:
+                print_replacements(rel_path, replacements)
+    
+    if modified_count:
+        pack.save_index()
+    return len(pack.records), modified_count
+
+def process_directory(directory, matcher, lexicon):
+    """Process the JSON files in the specified directory and its subdirectories.
+    Only files that are new, changed on disk or contain words whose lexicon entry changed
+    since the last run are reprocessed."""
+    metrics = instrumentation.get("lexicon")
     modified_count = 0
-    file_count = 0
+    lowercase_lexicon = [[k, v] for k, v in {k.lower(): v for k, v in lexicon.items()}.items()]
+    files_on_disk = scan_json_files(directory)
+
+    index = load_index(INDEX_PATH)
+    to_process = set(files_on_disk)
+    if index is not None:
+        indexed = index["files"]
+        changed_keys = lexicon_changes(dict(index["lexicon"]), dict(lowercase_lexicon))
+        wordless = wordless_keys(changed_keys) if changed_keys is not None else []
+        if changed_keys is None:
+            print("Lexicon order changed, reprocessing everything.")
+        elif wordless:
+            print(f"Lexicon entries without words changed ({', '.join(map(repr, wordless))}), reprocessing everything.")
+        else:
+            affected = files_affected_by(changed_keys, index)
+            to_process = {rel_path for rel_path, mtime_ns in files_on_disk.items()
+                          if rel_path in affected or indexed.get(rel_path, {}).get("mtime_ns") != mtime_ns}
+            if changed_keys:
+                print(f"Lexicon entries changed: {', '.join(sorted(changed_keys))}")
+    else:
+        index = {"files": {}}
+
+    print(f"{len(to_process)} of {len(files_on_disk)} JSON files need processing.")
     
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith('.json') and file != os.path.basename(LEXICON_PATH):
-                file_path = os.path.join(root, file)
-                file_count += 1
-                modified, replacements = process_json_file(file_path, lexicon)
-                
-                if modified:
-                    modified_count += 1
-                    print(f"\nModified: {file_path}")
-                    
-                    # Group replacements by original word for cleaner output
-                    replacement_counts = {}
-                    for orig, repl in replacements:
-                        if (orig, repl) not in replacement_counts:
-                            replacement_counts[(orig, repl)] = 1
-                        else:
-                            replacement_counts[(orig, repl)] += 1
-                    
-                    # Print the replacements made in this file
-                    for (orig, repl), count in replacement_counts.items():
-                        print(f"  - Replaced '{orig}' with '{repl}' ({count} times)")
+    files_index = {rel_path: entry for rel_path, entry in index["files"].items() if rel_path in files_on_disk}
+    for done, rel_path in enumerate(sorted(to_process), 1):
+        file_path = os.path.join(directory, rel_path)
+        with metrics.span("lexicon", rel_path):
+            modified, replacements, words = process_json_file(file_path, matcher)
+        files_index[rel_path] = {"mtime_ns": os.stat(file_path).st_mtime_ns, "words": sorted(words)}
+        
+        if modified:
+            modified_count += 1
+            metrics.count("modified")
+            if VERBOSE:
+                print_replacements(file_path, replacements)
+        metrics.progress(done, len(to_process))
     
-    return file_count, modified_count
+    save_index({"lexicon": lowercase_lexicon, "files": files_index}, INDEX_PATH)
+    return len(to_process), modified_count
 
 def main():
     print(f"Starting text replacement in JSON files (case-insensitive)...")
-    print(f"Directory: {DIRECTORY_TO_PROCESS}")
+    print(f"Directory: {PACK_DIR or DIRECTORY_TO_PROCESS}")
     print(f"Lexicon file: {LEXICON_PATH}")
     
     lexicon = load_lexicon(LEXICON_PATH)
     print(f"Loaded lexicon with {len(lexicon)} entries.")
+    matcher = LexiconMatcher(lexicon)
     
-    total_files, modified_files = process_directory(DIRECTORY_TO_PROCESS, lexicon)
+    if PACK_DIR:
+        total_files, modified_files = process_pack(PACK_DIR, matcher)
+    else:
+        total_files, modified_files = process_directory(DIRECTORY_TO_PROCESS, matcher, lexicon)
     
+    instrumentation.get("lexicon").finish()
     print(f"\nSummary:")
     print(f"Processed {total_files} JSON files.")
     print(f"Modified {modified_files} files.")
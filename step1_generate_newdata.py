@@ -2,53 +2,283 @@ import os
 import json
 import shutil
 import re
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import soundfile as sf
+import instrumentation
+from deploy import deployed_stats, file_stat
+from packed_store import PackWriter, PackedStore
 
 SOURCE_DIR = "N:/XIV_Voices/Data"  # Original folder
 NEW_DATA_DIR = "data/OrigData"  # Destination for filtered JSONs & converted WAVs
 ORIGINAL_OGG_DIR = "data/OriginalOggs"  # Backup folder for original .ogg files
+MANIFEST_PATH = "data/step1_manifest.json"  # Remembers what has already been scanned
+# What deploy.py put into SOURCE_DIR. Those OGGs are our own lines, not new originals, so
+# they're never backed up or decoded.
+DEPLOY_MANIFEST_PATH = "data/deploy_manifest.json"
+WORKERS = os.cpu_count() or 1  # Number of processes used for scanning/decoding
+MANIFEST_SAVE_EVERY = 500  # Save the manifest every N processed files in case of a crash
+# Write the matched lines into one packed file (see packed_store.py) instead of thousands of
+# loose JSONs and WAVs in NEW_DATA_DIR
+PACK_OUTPUT = False
+PACK_DIR = "data/OrigPack"
+# Don't decode the OGGs to WAVs at all, step 2 decodes the references it actually uses from
+# ORIGINAL_OGG_DIR (set LAZY_OGG_DIR there). Ignored with PACK_OUTPUT.
+LAZY_DECODE = False
+VERBOSE = False  # Print every file that is copied/converted instead of a progress line
 FILTER_PATTERN = re.compile(r"Arc[^a-z]|_NAME_|_FIRSTNAME_")
+# Same pattern on the raw file bytes, so files that can't match are never parsed
+FILTER_PATTERN_BYTES = re.compile(FILTER_PATTERN.pattern.encode("ascii"))
+# Settings the worker processes read. With the spawn start method (Windows, macOS) they
+# import this module afresh, so whatever a caller changed is handed to them by worker_pool()
+WORKER_SETTINGS = ("SOURCE_DIR", "NEW_DATA_DIR", "ORIGINAL_OGG_DIR", "PACK_OUTPUT", "PACK_DIR", "LAZY_DECODE", "VERBOSE")
+
+def worker_init(settings):
+    globals().update(settings)
+
+def worker_pool():
+    """A process pool whose workers see this module's current settings."""
+    settings = {name: globals()[name] for name in WORKER_SETTINGS}
+    return ProcessPoolExecutor(max_workers=WORKERS, initializer=worker_init, initargs=(settings,))
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_manifest(manifest_path):
+    """Load the manifest from the last run, or an empty one if there isn't one yet."""
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_manifest(manifest, manifest_path):
+    """Write the manifest atomically so a crash can't leave a half written file."""
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+def scan_source(directory):
+    """Yield (relative json path, size, mtime_ns) for every JSON in the source tree.
+    Uses scandir so the stat comes for free on Windows."""
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".json"):
+                    st = entry.stat()
+                    yield os.path.relpath(entry.path, directory), st.st_size, st.st_mtime_ns
+
+def ogg_stat(rel_json):
+    """Return (size, mtime_ns) of the OGG next to a JSON, or None if there isn't one."""
+    ogg_path = os.path.join(SOURCE_DIR, rel_json[:-len(".json")] + ".ogg")
+    try:
+        st = os.stat(ogg_path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+def is_fresh(entry, size, mtime_ns, rel_json, deployed=None):
+    """Check if a manifest entry still describes the source file and its outputs.
+    deployed is deployed_stats(), an OGG that deploy.py put there (the very same file,
+    inode included) doesn't count as a change."""
+    if entry is None or entry["size"] != size or entry["mtime_ns"] != mtime_ns:
+        return False
+    if entry.get("mode", "loose") != output_mode():
+        return False
+    if not entry["match"]:
+        return True
+    rel_ogg = rel_json[:-len(".json")] + ".ogg"
+    if not (deployed and rel_ogg in deployed and file_stat(os.path.join(SOURCE_DIR, rel_ogg)) == deployed[rel_ogg]):
+        ogg = ogg_stat(rel_json)
+        if (ogg is None) != (entry.get("ogg") is None):
+            return False
+        if ogg is not None and list(ogg) != entry["ogg"]:
+            return False
+    output_paths = output_paths_for(rel_json)
+    return all(os.path.exists(output_paths[key]) for key in entry["outputs"])
+
+def output_mode():
+    if PACK_OUTPUT:
+        return "packed"
+    return "lazy" if LAZY_DECODE else "loose"
+
+def output_paths_for(rel_json):
+    rel_ogg = rel_json[:-len(".json")] + ".ogg"
+    return {
+        "json": os.path.join(NEW_DATA_DIR, rel_json),
+        "ogg_backup": os.path.join(ORIGINAL_OGG_DIR, rel_ogg),
+        "wav": os.path.join(NEW_DATA_DIR, rel_ogg[:-len(".ogg")] + ".wav"),
+    }
+
+def json_matches(json_path):
+    """Check if a JSON's sentence contains the name/Arc pattern.
+    The raw bytes are searched first, almost nothing matches so almost nothing gets parsed,
+    then only the sentence is checked so hits in other keys are dropped."""
+    with open(json_path, "rb") as f:
+        raw = f.read()
+
+    if not FILTER_PATTERN_BYTES.search(raw):
+        return False
+
+    contents = json.loads(raw)
+    sentence = contents.get("sentence", "") if isinstance(contents, dict) else ""
+    return isinstance(sentence, str) and FILTER_PATTERN.search(sentence) is not None
+
+def process_json(rel_json, size, mtime_ns, deployed_ogg=None):
+    """Worker: filter a single JSON and, if it matches, copy it and convert its OGG.
+    deployed_ogg is the file_stat() of the OGG deploy.py put in its place, if any.
+    Returns the manifest entry for the file and the timings of its parts."""
+    json_path = os.path.join(SOURCE_DIR, rel_json)
+    spans = instrumentation.Spans()
+
+    entry = {"size": size, "mtime_ns": mtime_ns, "match": False, "ogg": None, "outputs": {}, "mode": output_mode()}
+    with spans("read"):
+        matches = json_matches(json_path)
+    if not matches:
+        return rel_json, entry, spans.observations
+
+    entry["match"] = True
+    output_paths = output_paths_for(rel_json)
+
+    if not PACK_OUTPUT:
+        new_json_path = output_paths["json"]
+        with spans("copy"):
+            os.makedirs(os.path.dirname(new_json_path), exist_ok=True)
+            shutil.copy2(json_path, new_json_path)
+            entry["outputs"]["json"] = file_sha1(new_json_path)
+        if VERBOSE:
+            print(f"Copied JSON: {json_path} -> {new_json_path}")
+
+    ogg_path = os.path.join(SOURCE_DIR, rel_json[:-len(".json")] + ".ogg")
+    if os.path.exists(ogg_path):
+        st = os.stat(ogg_path)
+        entry["ogg"] = [st.st_size, st.st_mtime_ns]
+
+        # Backup original .ogg
+        original_ogg_backup = output_paths["ogg_backup"]
+        if deployed_ogg is not None and os.path.exists(original_ogg_backup):
+            # One of our lines, the backup still has the original (with its size and mtime,
+            # so the line stays fresh once it's rolled back). Never back up over it, even if
+            # the deployed file changed since
+            if file_stat(ogg_path) != deployed_ogg:
+                print(f"Warning: {ogg_path} changed since deploy.py put it there, keeping the original in "
+                      f"{original_ogg_backup}. If a game update replaced it, delete that backup and run step 1 again.")
+            ogg_path = original_ogg_backup
+            st = os.stat(ogg_path)
+            entry["ogg"] = [st.st_size, st.st_mtime_ns]
+            entry["outputs"]["ogg_backup"] = file_sha1(original_ogg_backup)
+        else:
+            with spans("backup"):
+                os.makedirs(os.path.dirname(original_ogg_backup), exist_ok=True)
+                shutil.copy2(ogg_path, original_ogg_backup)
+                entry["outputs"]["ogg_backup"] = file_sha1(original_ogg_backup)
+            if VERBOSE:
+                print(f"Backed up original OGG: {ogg_path} -> {original_ogg_backup}")
+
+        # Convert .ogg to .wav, packed mode decodes it in update_pack() instead and lazy
+        # mode leaves it to step 2
+        if output_mode() == "loose":
+            wav_path = output_paths["wav"]
+            with spans("decode"):
+                os.makedirs(os.path.dirname(wav_path), exist_ok=True)
+                convert_ogg_to_wav(ogg_path, wav_path)
+                entry["outputs"]["wav"] = file_sha1(wav_path)
+            if VERBOSE:
+                print(f"Converted OGG to WAV: {ogg_path} -> {wav_path}")
+
+    return rel_json, entry, spans.observations
+
+def decode_for_pack(rel_json):
+    """Worker: read a matched JSON and decode its OGG for the pack, from the backup
+    because the OGG in SOURCE_DIR may have been replaced by deploy.py."""
+    with open(os.path.join(SOURCE_DIR, rel_json), "r", encoding="utf-8") as f:
+        contents = json.load(f)
+    data, samplerate = sf.read(output_paths_for(rel_json)["ogg_backup"], dtype="float32")
+    return rel_json, contents, data, samplerate
+
+def update_pack(manifest):
+    """Write the matched lines into the pack. Lines whose source is unchanged are copied
+    over from the current pack, only new or changed ones are decoded."""
+    old_pack = PackedStore(PACK_DIR) if PackedStore.exists(PACK_DIR) else None
+    to_decode = {}
+    reused = []
+    for rel_json, entry in sorted(manifest.items()):
+        if not entry["match"] or entry["ogg"] is None:
+            continue
+        source = [entry["size"], entry["mtime_ns"], entry["ogg"]]
+        record = old_pack.records.get(rel_json) if old_pack is not None else None
+        if record is not None and record.get("source") == source:
+            reused.append(rel_json)
+        else:
+            to_decode[rel_json] = source
+    if not to_decode and old_pack is not None and len(reused) == len(old_pack.records):
+        print(f"Pack {PACK_DIR} is up to date ({len(reused)} lines).")
+        return
+
+    writer = PackWriter(PACK_DIR)
+    for rel_json in reused:
+        writer.add_pcm(rel_json, old_pack.records[rel_json], old_pack.audio(rel_json))
+    with worker_pool() as pool:
+        for rel_json, contents, data, samplerate in pool.map(decode_for_pack, to_decode, chunksize=16):
+            writer.add(rel_json, contents, data, samplerate, source=to_decode[rel_json])
+    writer.close()
+    print(f"Packed {len(reused) + len(to_decode)} lines into {PACK_DIR} ({len(to_decode)} decoded, {len(reused)} unchanged).")
 
 def copy_and_convert_files():
-    total_files = 0
-    converted_files = 0
-
-    for root, _, files in os.walk(SOURCE_DIR):
-        for file in files:
-            if file.endswith(".json"):
-                json_path = os.path.join(root, file)
-
-                with open(json_path, "r", encoding="utf-8") as f:
-                    contents = json.load(f)
-                    json_text = json.dumps(contents)
-
-                if FILTER_PATTERN.search(json_text):
-                    total_files += 1
-
-                    rel_path = os.path.relpath(root, SOURCE_DIR)
-                    new_json_path = os.path.join(NEW_DATA_DIR, rel_path, file)
-                    os.makedirs(os.path.dirname(new_json_path), exist_ok=True)
-                    shutil.copy2(json_path, new_json_path)
-                    print(f"Copied JSON: {json_path} -> {new_json_path}")
-
-                    ogg_file = file.replace(".json", ".ogg")
-                    ogg_path = os.path.join(root, ogg_file)
-
-                    if os.path.exists(ogg_path):
-                        # Backup original .ogg
-                        original_ogg_backup = os.path.join(ORIGINAL_OGG_DIR, rel_path, ogg_file)
-                        os.makedirs(os.path.dirname(original_ogg_backup), exist_ok=True)
-                        shutil.copy2(ogg_path, original_ogg_backup)
-                        print(f"Backed up original OGG: {ogg_path} -> {original_ogg_backup}")
-
-                        # Convert .ogg to .wav
-                        wav_path = os.path.join(NEW_DATA_DIR, rel_path, ogg_file.replace(".ogg", ".wav"))
-                        os.makedirs(os.path.dirname(wav_path), exist_ok=True)
-                        convert_ogg_to_wav(ogg_path, wav_path)
-                        converted_files += 1
-                        print(f"Converted OGG to WAV: {ogg_path} -> {wav_path}")
-
-    print(f"Finished Step 1: {total_files} JSON files copied, {converted_files} OGG files converted.")
+    metrics = instrumentation.get("step1")
+    manifest = load_manifest(MANIFEST_PATH)
+    deployed = deployed_stats(DEPLOY_MANIFEST_PATH)
+    new_manifest = {}
+    pending = []
+
+    for rel_json, size, mtime_ns in scan_source(SOURCE_DIR):
+        entry = manifest.get(rel_json)
+        if is_fresh(entry, size, mtime_ns, rel_json, deployed):
+            new_manifest[rel_json] = entry
+        else:
+            pending.append((rel_json, size, mtime_ns, deployed.get(rel_json[:-len(".json")] + ".ogg")))
+
+    print(f"{len(new_manifest)} files unchanged since the last run, {len(pending)} to process.")
+    metrics.count("unchanged", len(new_manifest))
+
+    done = 0
+    if pending:
+        with worker_pool() as pool:
+            futures = {pool.submit(process_json, *job): job[0] for job in pending}
+            for future in as_completed(futures):
+                try:
+                    rel_json, entry, observations = future.result()
+                except Exception as e:
+                    print(f"Error processing file {futures[future]}: {e}")
+                    metrics.count("errors")
+                    continue
+                new_manifest[rel_json] = entry
+                metrics.merge(observations, rel_json)
+                metrics.count("matched" if entry["match"] else "filtered_out")
+                done += 1
+                metrics.progress(done, len(pending))
+                if done % MANIFEST_SAVE_EVERY == 0:
+                    save_manifest(new_manifest, MANIFEST_PATH)
+
+    save_manifest(new_manifest, MANIFEST_PATH)
+    if PACK_OUTPUT:
+        update_pack(new_manifest)
+
+    total_files = sum(1 for entry in new_manifest.values() if entry["match"])
+    converted_files = sum(1 for entry in new_manifest.values()
+                          if entry["match"] and entry["ogg"] is not None and entry.get("mode") != "lazy")
+    metrics.finish()
+    print(f"Finished Step 1: {total_files} JSON files copied, {converted_files} OGG files converted ({done} processed this run).")
 
 def convert_ogg_to_wav(ogg_path, wav_path):
     data, samplerate = sf.read(ogg_path)
@@ -1,180 +1,681 @@
 import os
+import sys
 import json
 import re
-import random
-from f5_tts.api import F5TTS
+import time
+import argparse
+import numpy as np
+import instrumentation
+import quality_gate
+from tts_worker import load_backend, TTSClient
+from reference_index import ReferenceIndex
+from output_cache import OutputCache, cache_key, link_or_copy
+from ogg_encoder import OggEncoderPool
+from packed_store import PackedStore, PackedAudio
+from decoded_audio_cache import LazyOgg
+from job_journal import JobJournal, parse_shard
+from job_table import JobTable
 
 # === CONFIGURATION ===
 SPECIFIED_NAME = "v'zicksa"  # Set the replacement name here
 NEW_DATA_DIR = "data/OrigData"         # Source folder from Step 1
+PACK_DIR = None  # Set to "data/OrigPack" to read the pack made by step 1 with PACK_OUTPUT
+# Set to "data/OriginalOggs" when step 1 ran with LAZY_DECODE: references are then picked
+# from the original OGGs and only the ones that get used are decoded, into DECODED_CACHE_DIR
+LAZY_OGG_DIR = None
+DECODED_CACHE_DIR = "data/DecodedCache"
 CUSTOM_DATA_DIR = "data/CustomData"   # Step 2 output folder
+CONVERTED_DATA_DIR = "data/FinalOggData"  # Final OGGs, only used with FUSED_OGG_OUTPUT
+# Encode each line straight to OGG in FinalOggData on background threads while the GPU
+# carries on, so step 3 isn't needed. WAVs are then only written if KEEP_WAV_OUTPUT is on.
+FUSED_OGG_OUTPUT = False
+KEEP_WAV_OUTPUT = False
 # Regex pattern to detect relevant lines
 FILTER_PATTERN = re.compile(r"Arc(?=[^a-z])|_NAME_|_FIRSTNAME_")
-# Initialize TTS API
-f5tts = F5TTS()
-
-def get_ellipsis_suffix(text_length):
-    if text_length < 10:
-        return " ..."
-    elif text_length < 20:
-        return " ..."
-    elif text_length < 40:
-        return " ..."
-    elif text_length < 60:
-        return ""
-    else:
-        return ""
-
-def find_suitable_wav(original_wav_path, min_size_kb=350):
-    """Find a suitable WAV file in the same folder:
-    - If original is smaller than 150KB, find one over 250KB
-    - If no file over 250KB exists, use the largest one in the folder
-    """
-    original_size_kb = os.path.getsize(original_wav_path) / 1024
-    
-    print(f"Original file: {os.path.basename(original_wav_path)} is {original_size_kb:.2f}KB")
-    
-    # If original file is already big enough, use it
-    if original_size_kb >= 250:
-        print(f"Using original file as it's larger than 150KB")
-        return original_wav_path
-    
-    # Get all wav files in the same directory
-    directory = os.path.dirname(original_wav_path)
-    wav_files = [os.path.join(directory, f) for f in os.listdir(directory) 
-                if f.endswith('.wav') and os.path.isfile(os.path.join(directory, f))]
-    
-    # Find files over min_size_kb
-    suitable_files = [f for f in wav_files if os.path.getsize(f) / 1024 >= min_size_kb]
-    
-    if suitable_files:
-        # Choose a random file from suitable ones
-        chosen_file = random.choice(suitable_files)
-        chosen_size_kb = os.path.getsize(chosen_file) / 1024
-        print(f"Found better file: {os.path.basename(chosen_file)} ({chosen_size_kb:.2f}KB)")
-        return chosen_file
-    else:
-        # If no suitable file found, use the largest one
-        if wav_files:
-            largest_file = max(wav_files, key=os.path.getsize)
-            if largest_file != original_wav_path:
-                largest_size_kb = os.path.getsize(largest_file) / 1024
-                print(f"No files over {min_size_kb}KB found. Using largest: {os.path.basename(largest_file)} ({largest_size_kb:.2f}KB)")
-                return largest_file
-    
-    # If we get here, either:
-    # 1. No better alternatives were found
-    # 2. Original file was the largest available
-    print(f"Using original file: {os.path.basename(original_wav_path)}")
-    return original_wav_path
-
-
-def process_jsons_and_generate():
-    processed_files = 0
-    skipped_files = 0
+# "f5" loads F5-TTS in this process, "worker" sends jobs to a running tts_worker.py
+# so the model stays loaded between runs, "stub" is a CPU stand-in for testing
+TTS_BACKEND = "f5"
+REF_CACHE_DIR = "data/RefCache"  # Preprocessed references + transcripts, set to None to disable
+REF_INDEX_PATH = "data/reference_index.json"  # Per-speaker reference stats, rebuilt incrementally each run
+REFERENCE_SEED = 0  # Change to get a different (but reproducible) choice of reference WAVs
+NFE_STEP = 32  # Lower is faster but noisier, see the README
+# Lines that share a reference and speed bucket are generated together, up to this many
+# per forward pass. 1 generates one line at a time.
+BATCH_SIZE = 1
+# Generated lines are stored here by a hash of their inputs, so identical lines are only
+# generated once and going back to an earlier name spelling reuses its results.
+# Set to None to disable.
+OUTPUT_CACHE_DIR = "data/GenCache"
+# Track lines in a SQLite journal (see job_journal.py), e.g. "data/step2_jobs.sqlite",
+# instead of skipping every line whose WAV exists, so a crashed run is resumed properly and
+# several machines can share the work with --shard. Off by default, --journal turns it on.
+JOURNAL_PATH = None
+CLAIM_SIZE = 32  # Lines a worker takes from the journal at a time
+VERBOSE = False  # Print a few lines per file instead of a progress line
+# Check every generated line (length, silences, clipping, loudness) and generate the
+# broken ones again with another seed or reference, see quality_gate.py
+QUALITY_GATE = False
+# Every run first plans its lines (text, speed, reference) and saves the plan here, see
+# job_table.py and --dry-run / --preview-name
+PLAN_PATH = "data/step2_plan.npz"
+PLAN_ORDER = "reference"  # Generate lines in "reference" (best for batching) or "length" order
+LENGTH_BUCKETS = (10, 20, 40, 60)  # Text lengths where the speed changes
+SPEEDS = (0.4, 0.5, 0.6, 0.8, 0.9)  # Speed below, between and above those lengths
+ELLIPSIS_SUFFIXES = (" ...", " ...", " ...", "", "")  # Appended to the text, per length bucket
+
+def get_tts():
+    """Create the TTS backend, this is where the model gets loaded."""
+    if TTS_BACKEND == "worker":
+        return TTSClient()
+    return load_backend(TTS_BACKEND, REF_CACHE_DIR)
+
+def length_buckets(lengths):
+    """The LENGTH_BUCKETS bucket of each text length, an index into SPEEDS and ELLIPSIS_SUFFIXES."""
+    return np.searchsorted(LENGTH_BUCKETS, lengths, side="right")
+
+def shape_sentence(sentence, name):
+    """The text substitutions, before the length dependent speed and ellipsis."""
+    # Goodbye, Warrior of Our Friend
+    sentence = re.sub(r"\bWarrior of\s+(?:_NAME_|_FIRSTNAME_|Arc)(?=[^a-zA-Z]|$)", "Warrior of Light", sentence)
+
+    # Remove comma and space before the matched pattern (to avoid awkward pauses)
+    cleaned_sentence = re.sub(r",\s+(?=" + FILTER_PATTERN.pattern + r")", " ", sentence)
+
+    # Replace the filtered pattern with the specified name
+    gen_text = FILTER_PATTERN.sub(name, cleaned_sentence)
+
+    if gen_text.endswith("."):
+        gen_text = gen_text.strip()[:-1]
+    return re.sub(r'^[^\w\s]+', '', gen_text.strip())
+
+def prepare_gen_texts(sentences, name):
+    """Turn sentences from the game into the texts to generate and their speeds (an array).
+    The speed and ellipsis buckets are worked out for all sentences at once."""
+    shaped = [shape_sentence(sentence, name) for sentence in sentences]
+    lengths = np.fromiter((len(text.strip()) for text in shaped), dtype=np.int64, count=len(shaped))
+    buckets = length_buckets(lengths)
+    gen_texts = [(text + ELLIPSIS_SUFFIXES[bucket]).replace("!", ".") for text, bucket in zip(shaped, buckets)]
+    return gen_texts, np.asarray(SPEEDS)[buckets]
+
+def iter_lines(pack=None):
+    """Yield (relative JSON path, contents) for every line from step 1, from the pack if
+    one is given, otherwise from NEW_DATA_DIR."""
+    if pack is not None:
+        for rel_json, record in sorted(pack.records.items()):
+            yield rel_json, record["contents"]
+        return
     for root, _, files in os.walk(NEW_DATA_DIR):
         for file in files:
             if file.endswith(".json"):
-                json_path = os.path.join(root, file)
-                with open(json_path, "r", encoding="utf-8") as f:
-                    contents = json.load(f)
-                sentence = contents.get("sentence", "")
-                if not FILTER_PATTERN.search(sentence):
-                    continue  # Skip if pattern not matched
-                
-                # Goodbye, Warrior of Our Friend
-                sentence = re.sub(r"\bWarrior of\s+(?:_NAME_|_FIRSTNAME_|Arc)(?=[^a-zA-Z]|$)", "Warrior of Light", sentence)
-
-                # Remove comma and space before the matched pattern (to avoid awkward pauses)
-                cleaned_sentence = re.sub(r",\s+(?=" + FILTER_PATTERN.pattern + r")", " ", sentence)
-
-                # Replace the filtered pattern with the specified name
-                gen_text = FILTER_PATTERN.sub(SPECIFIED_NAME, cleaned_sentence)
-
-                if gen_text.endswith("."):
-                    gen_text = gen_text.strip()[:-1]
-                gen_text = re.sub(r'^[^\w\s]+', '', gen_text.strip())
-
-                text_len = len(gen_text.strip())
-
-                if text_len < 10:
-                    speedv = 0.4
-                elif text_len < 20:
-                    speedv = 0.5
-                elif text_len < 40:
-                    speedv = 0.6
-                elif text_len < 60:
-                    speedv = 0.8
-                else:
-                    speedv = 0.9
-
-                gen_text += get_ellipsis_suffix(len(gen_text.strip()))
-                gen_text = gen_text.replace("!", ".")
-
-                rel_path = os.path.relpath(root, NEW_DATA_DIR)
-                ref_wav_path_original = os.path.join(root, file.replace(".json", ".wav"))
-                new_wav_path = os.path.join(CUSTOM_DATA_DIR, rel_path, file.replace(".json", ".wav"))
-
-                # Skip generation if file already exists
-                if os.path.exists(new_wav_path):
-                    print(f"Skipping {file} - Output WAV already exists.")
-                    skipped_files += 1
-                    continue
-
-                ref_wav_path = find_suitable_wav(ref_wav_path_original, 250)
-
-                if ref_wav_path != ref_wav_path_original:
-                    print(f"Using alternative reference WAV: {os.path.basename(ref_wav_path)}")
-
-                os.makedirs(os.path.dirname(new_wav_path), exist_ok=True)
-
-                print(f"Generating speech for: {file}")
-                wav, sr, spec = f5tts.infer(
-                    ref_file=ref_wav_path,
-                    ref_text="",
-                    gen_text=gen_text,
-                    file_wave=new_wav_path,
-                    seed=None,
-                    nfe_step=32,
-                    speed=speedv,
-                )
-
-                new_json_path = os.path.join(CUSTOM_DATA_DIR, rel_path, file)
-                os.makedirs(os.path.dirname(new_json_path), exist_ok=True)
-                # Load original JSON again to append metadata
-                with open(json_path, "r", encoding="utf-8") as f:
-                    original_data = json.load(f)
-
-                # Add generation parameters
-                original_data["generation_parameters"] = {
-                    "ref_file": ref_wav_path,
-                    "ref_text": "",
-                    "gen_text": gen_text,
-                    "file_wave": new_wav_path,
-                    "seed": None,
-                    "nfe_step": 32,
-                    "speed": speedv,
-                }
-
-                # Add reference WAV path if it's not the original
-                if ref_wav_path != ref_wav_path_original:
-                    original_data["reference_wav_used"] = ref_wav_path
-
-                # Save updated JSON to CustomData
-                new_json_path = os.path.join(CUSTOM_DATA_DIR, rel_path, file)
-                os.makedirs(os.path.dirname(new_json_path), exist_ok=True)
-                with open(new_json_path, "w", encoding="utf-8") as f:
-                    json.dump(original_data, f, ensure_ascii=False, indent=2)
-
-                processed_files += 1
-                print(f"Processed {file} - New WAV saved to {new_wav_path}")
-
-    print(f"Finished Step 2: {processed_files} files processed, {skipped_files} skipped (already exist).")
+                with open(os.path.join(root, file), "r", encoding="utf-8") as f:
+                    yield os.path.relpath(os.path.join(root, file), NEW_DATA_DIR), json.load(f)
+
+def original_reference(rel_json):
+    """The line's own audio from step 1, its first choice of reference."""
+    if LAZY_OGG_DIR:
+        return os.path.join(LAZY_OGG_DIR, rel_json[:-len(".json")] + ".ogg")
+    return os.path.join(NEW_DATA_DIR, rel_json[:-len(".json")] + ".wav")
+
+def plan_jobs(lines, ref_index):
+    """The planning pass: pick out the lines that mention the player, shape their text and
+    choose their references, without loading the model. lines are (relative JSON path,
+    contents) pairs. Returns the JobTable and the contents of the planned lines."""
+    metrics = instrumentation.get("step2")
+    rel_jsons, sentences, contents_by_line = [], [], {}
+    for rel_json, contents in lines:
+        sentence = contents.get("sentence", "") if isinstance(contents, dict) else ""
+        if FILTER_PATTERN.search(sentence):
+            rel_jsons.append(rel_json)
+            sentences.append(sentence)
+            contents_by_line[rel_json] = contents
+
+    with metrics.span("prepare"):
+        gen_texts, speeds = prepare_gen_texts(sentences, SPECIFIED_NAME)
+    refs, ref_hashes = [], []
+    for rel_json in rel_jsons:
+        with metrics.span("reference", rel_json):
+            ref_wav_path = ref_index.choose(original_reference(rel_json), REFERENCE_SEED)
+        ref_stats = ref_index.stats(ref_wav_path)
+        refs.append(ref_wav_path)
+        ref_hashes.append(ref_stats["sha1"] if ref_stats else os.path.abspath(ref_wav_path))
+
+    table = JobTable({
+        "rel_json": rel_jsons,
+        "sentence": sentences,
+        "gen_text": gen_texts,
+        "length": [len(gen_text) for gen_text in gen_texts],
+        "speed": speeds,
+        "ref": refs,
+        "ref_hash": ref_hashes,
+        "cache_key": [cache_key(gen_text, ref_hash, NFE_STEP, float(speed), None, SPECIFIED_NAME)
+                      for gen_text, ref_hash, speed in zip(gen_texts, ref_hashes, speeds)],
+    }, {"name": SPECIFIED_NAME, "nfe_step": NFE_STEP, "reference_seed": REFERENCE_SEED})
+    return table, contents_by_line
+
+def reference_file(ref_wav_path, ref_hash, packed):
+    """What to hand the TTS backend as the reference: a path, or audio from the pack or
+    the decoded OGG cache."""
+    if packed:
+        ref_rel_json = os.path.relpath(ref_wav_path, NEW_DATA_DIR)[:-len(".wav")] + ".json"
+        return PackedAudio(PACK_DIR, ref_rel_json, ref_hash)
+    if LAZY_OGG_DIR:
+        return LazyOgg(ref_wav_path, ref_hash, DECODED_CACHE_DIR)
+    return ref_wav_path
+
+def job_from_row(row, contents, pack=None, name=None):
+    """Turn a row of the plan into everything needed to generate and save the line.
+    name is the one the row was planned with, SPECIFIED_NAME if not given."""
+    rel_json = row["rel_json"]
+    rel_path, file = os.path.split(rel_json)
+    new_wav_path = os.path.join(CUSTOM_DATA_DIR, rel_path, file.replace(".json", ".wav"))
+    new_ogg_path = os.path.join(CONVERTED_DATA_DIR, rel_path, file.replace(".json", ".ogg"))
+    output_path = new_ogg_path if FUSED_OGG_OUTPUT else new_wav_path
+
+    ref_wav_path = row["ref"]
+    return {
+        "rel_json": rel_json,
+        "file": file,
+        "contents": contents,
+        "gen_text": row["gen_text"],
+        "speed": row["speed"],
+        "ref_wav_path": ref_wav_path,
+        "ref_file": reference_file(ref_wav_path, row["ref_hash"], pack is not None),
+        "ref_wav_path_original": original_reference(rel_json),
+        "new_wav_path": new_wav_path if KEEP_WAV_OUTPUT or not FUSED_OGG_OUTPUT else None,
+        "new_ogg_path": new_ogg_path if FUSED_OGG_OUTPUT else None,
+        "output_path": output_path,
+        "new_json_path": os.path.join(CUSTOM_DATA_DIR, rel_path, file),
+        "cache_key": row["cache_key"],
+        "name": name or SPECIFIED_NAME,
+    }
+
+def make_job(rel_json, contents, ref_index, pack=None):
+    """Plan a single line. Returns None if the line doesn't need a new voice."""
+    table, _ = plan_jobs([(rel_json, contents)], ref_index)
+    if not len(table):
+        return None
+    return job_from_row(table.row(0), contents, pack)
+
+def jobs_from_table(table, contents_by_line, pack=None, skip_existing=True):
+    """Turn the plan into jobs, in its order. Returns (jobs, number skipped because the
+    output already exists). With skip_existing off every line is returned, the journal
+    decides what's left to do."""
+    metrics = instrumentation.get("step2")
+    jobs = []
+    skipped_files = 0
+    for row in table.rows():
+        job = job_from_row(row, contents_by_line[row["rel_json"]], pack)
+
+        # Skip generation if file already exists
+        if skip_existing and os.path.exists(job["output_path"]):
+            metrics.log(f"Skipping {job['file']} - Output already exists.", VERBOSE)
+            skipped_files += 1
+            continue
+
+        if job["ref_wav_path"] != job["ref_wav_path_original"]:
+            metrics.count("alternative_references")
+            metrics.log(f"Using alternative reference WAV: {os.path.basename(job['ref_wav_path'])}", VERBOSE)
+        jobs.append(job)
+    return jobs, skipped_files
+
+def plan(ref_index, pack=None):
+    """Plan every line from step 1, in PLAN_ORDER, and save the plan to PLAN_PATH."""
+    table, contents_by_line = plan_jobs(iter_lines(pack), ref_index)
+    table = table.sorted(PLAN_ORDER)
+    table.save(PLAN_PATH)
+    return table, contents_by_line
+
+def print_plan(table, output_cache):
+    """What a run with this plan would do, for --dry-run."""
+    summary = table.summary()
+    keys = table.columns["cache_key"]
+    cached = sum(1 for key in set(keys.tolist()) if output_cache is not None and output_cache.get(key) is not None)
+    print(f"{summary['lines']} lines, {summary['unique_outputs']} different outputs ({cached} already in the cache), "
+          f"{summary['references']} references, {summary['characters']} characters.")
+    print("Lines per speed: " + ", ".join(f"{speed}: {count}" for speed, count in summary["speeds"].items()))
+    if VERBOSE:
+        for row in table.rows():
+            print(f"{row['rel_json']} [{row['speed']}, {os.path.basename(row['ref'])}]: {row['gen_text']}")
+    print(f"Plan saved to {PLAN_PATH}.")
+
+def preview_name(name, output_cache):
+    """Print the lines the last saved plan would generate with another name spelling,
+    using the references it chose, without scanning OrigData or loading the model."""
+    table = JobTable.load(PLAN_PATH)
+    gen_texts, speeds = prepare_gen_texts(table.columns["sentence"].tolist(), name)
+    to_generate = {}
+    cached = 0
+    for rel_json, gen_text, speed, ref_hash in zip(table.columns["rel_json"].tolist(), gen_texts, speeds.tolist(),
+                                                     table.columns["ref_hash"].tolist()):
+        key = cache_key(gen_text, ref_hash, table.meta["nfe_step"], speed, None, name)
+        if output_cache is not None and output_cache.get(key) is not None:
+            cached += 1
+        elif key in to_generate:
+            to_generate[key][1].append(rel_json)
+        else:
+            to_generate[key] = (gen_text, [rel_json])
+    for gen_text, rel_jsons in to_generate.values():
+        duplicates = f" (+{len(rel_jsons) - 1} identical)" if len(rel_jsons) > 1 else ""
+        print(f"{rel_jsons[0]}{duplicates}: {gen_text}")
+    print(f"'{name}' would generate {len(to_generate)} lines; {cached} of the {len(table)} planned lines "
+          f"are already in the cache.")
+
+def write_metadata(job):
+    """Save the original JSON plus the generation parameters in CustomData."""
+    original_data = dict(job["contents"])
+
+    # Add generation parameters
+    original_data["generation_parameters"] = {
+        "ref_file": job["ref_wav_path"],
+        "ref_text": "",
+        "gen_text": job["gen_text"],
+        "file_wave": job["new_wav_path"],
+        "seed": job.get("seed"),
+        "nfe_step": NFE_STEP,
+        "speed": job["speed"],
+    }
+    if job["new_ogg_path"] is not None:
+        original_data["generation_parameters"]["file_ogg"] = job["new_ogg_path"]
+
+    # Add reference WAV path if it's not the original
+    if job["ref_wav_path"] != job["ref_wav_path_original"]:
+        original_data["reference_wav_used"] = job["ref_wav_path"]
+    if job.get("quality_problems"):
+        original_data["quality_problems"] = job["quality_problems"]
+
+    # Save updated JSON to CustomData
+    os.makedirs(os.path.dirname(job["new_json_path"]), exist_ok=True)
+    tmp_path = job["new_json_path"] + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(original_data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, job["new_json_path"])
+
+def make_batches(jobs, batch_size):
+    """Group jobs by reference and speed bucket (the speed already encodes the text length
+    bucket and ellipsis), sort each group by length so batches need little padding, and
+    split into batches of at most batch_size."""
+    groups = {}
+    for job in jobs:
+        groups.setdefault((job["ref_wav_path"], job["speed"]), []).append(job)
+    batches = []
+    for group in groups.values():
+        group.sort(key=lambda job: len(job["gen_text"]))
+        for start in range(0, len(group), batch_size):
+            batches.append(group[start:start + batch_size])
+    return batches
+
+def tmp_wav_path(wav_path):
+    return wav_path[:-len(".wav")] + ".tmp.wav"
+
+def generate_batch(tts, batch):
+    """Generate one batch of jobs that share a reference and speed.
+    Returns a (wav, sr, spec) tuple per job.
+
+    The backends write their WAVs in place, so they're given temporary files (tmp_wav_path())
+    that gate_results() renames over the outputs once the quality gate accepts them. An
+    existing output may be a hardlink into the output cache (or deployed from one), writing
+    into it would change those as well, and a rejected line must not be left at the output
+    path where the next run would skip it."""
+    tmp_paths = []
+    for job in batch:
+        if job["new_wav_path"] is not None:
+            os.makedirs(os.path.dirname(job["new_wav_path"]), exist_ok=True)
+            tmp_paths.append(tmp_wav_path(job["new_wav_path"]))
+        instrumentation.get("step2").log(f"Generating speech for: {job['file']}", VERBOSE)
+
+    try:
+        if len(batch) == 1:
+            job = batch[0]
+            results = [tts.infer(
+                ref_file=job["ref_file"],
+                ref_text="",
+                gen_text=job["gen_text"],
+                file_wave=tmp_paths[0] if tmp_paths else None,
+                seed=job.get("seed"),
+                nfe_step=NFE_STEP,
+                speed=job["speed"],
+            )]
+        else:
+            results = tts.infer_batch(
+                ref_file=batch[0]["ref_file"],
+                ref_text="",
+                gen_texts=[job["gen_text"] for job in batch],
+                file_waves=tmp_paths or None,
+                seed=batch[0].get("seed"),
+                nfe_step=NFE_STEP,
+                speed=batch[0]["speed"],
+            )
+    except BaseException:
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    return results
+
+def accept_output(job):
+    """Move a generated WAV from its temporary file to the output path."""
+    if job["new_wav_path"] is not None:
+        os.replace(tmp_wav_path(job["new_wav_path"]), job["new_wav_path"])
+
+def discard_output(job):
+    if job["new_wav_path"] is not None and os.path.exists(tmp_wav_path(job["new_wav_path"])):
+        os.remove(tmp_wav_path(job["new_wav_path"]))
+
+def check_quality(job, wav, sr, ref_index=None):
+    """Run the quality gate on a generated line and return its problems, none if
+    QUALITY_GATE is off."""
+    if not QUALITY_GATE:
+        return []
+    ref_stats = ref_index.stats(job["ref_wav_path"]) if ref_index is not None else None
+    with instrumentation.get("step2").span("quality", job["rel_json"]):
+        return quality_gate.check(wav, sr, job["gen_text"], job["speed"], ref_stats["rms"] if ref_stats else None)
+
+def planned_key(job):
+    """The cache key a line was planned with. Duplicates wait on it, and it stays the same
+    when a retry switches to another reference (which changes the line's cache_key)."""
+    return job.get("planned_key", job["cache_key"])
+
+def retry_job(job, ref_index=None):
+    """A copy of a job that failed the quality gate, to generate again: with a new seed on
+    the first retry, then also with another reference from the same speaker if it has one."""
+    attempt = job.get("attempt", 0) + 1
+    retry = dict(job, attempt=attempt, seed=attempt, planned_key=planned_key(job))
+    if attempt >= 2 and ref_index is not None:
+        tried = job.get("tried_refs", [job["ref_wav_path"]])
+        other = ref_index.choose_other(job["ref_wav_path_original"], tried, REFERENCE_SEED + attempt)
+        if other is not None:
+            ref_stats = ref_index.stats(other)
+            ref_hash = ref_stats["sha1"] if ref_stats else os.path.abspath(other)
+            retry.update(ref_wav_path=other, tried_refs=tried + [other],
+                         ref_file=reference_file(other, ref_hash, isinstance(job["ref_file"], PackedAudio)),
+                         cache_key=cache_key(job["gen_text"], ref_hash, NFE_STEP, job["speed"], None, job["name"]))
+    return retry
+
+def gate_results(batch, results, ref_index=None):
+    """Split a generated batch into lines that passed the quality gate (or ran out of
+    retries) and retries of the ones that didn't. The WAVs of the lines that passed are
+    moved into place. Returns ([(job, wav, sr)], retries)."""
+    metrics = instrumentation.get("step2")
+    passed = []
+    retries = []
+    for job, (wav, sr, _) in zip(batch, results):
+        job["quality_problems"] = check_quality(job, wav, sr, ref_index)
+        if job["quality_problems"]:
+            metrics.count("quality_failed")
+            if job.get("attempt", 0) < quality_gate.MAX_RETRIES:
+                metrics.log(f"Generating {job['file']} again: {', '.join(job['quality_problems'])}", VERBOSE)
+                discard_output(job)
+                retries.append(retry_job(job, ref_index))
+                continue
+            print(f"{job['file']} still fails the quality gate, keeping it: {', '.join(job['quality_problems'])}")
+        accept_output(job)
+        passed.append((job, wav, sr))
+    metrics.count("retried", len(retries))
+    return passed, retries
+
+def dedupe_jobs(jobs, output_cache):
+    """Split jobs into ones that need the model and ones whose output can be reused.
+    Returns (jobs to generate, {cache key: jobs waiting on it}, jobs already in the cache)."""
+    to_generate = []
+    waiting = {}
+    cached = []
+    for job in jobs:
+        key = job["cache_key"]
+        if output_cache is not None and all(output_cache.get(key, ext) is not None for ext, _ in cached_outputs(job)):
+            cached.append(job)
+        elif key in waiting:
+            waiting[key].append(job)
+        else:
+            waiting[key] = []
+            to_generate.append(job)
+    return to_generate, waiting, cached
+
+def output_ext(job):
+    return os.path.splitext(job["output_path"])[1]
+
+def cached_outputs(job):
+    """[(extension, path)] of the files of a line that go into the output cache: the
+    output, and with FUSED_OGG_OUTPUT and KEEP_WAV_OUTPUT the WAV next to it."""
+    outputs = [(output_ext(job), job["output_path"])]
+    if job["new_wav_path"] is not None and job["new_wav_path"] != job["output_path"]:
+        outputs.append((".wav", job["new_wav_path"]))
+    return outputs
+
+def finish_job(job, journal=None):
+    """Write the line's JSON. Its audio is in place by now, so the line is done, unless it
+    still fails the quality gate: then it's marked failed for --retry-failed."""
+    metrics = instrumentation.get("step2")
+    with metrics.span("write", job["rel_json"]):
+        write_metadata(job)
+    if journal is not None:
+        if job.get("quality_problems"):
+            journal.failed(job["rel_json"], "Quality gate: " + ", ".join(job["quality_problems"]), final=True)
+        else:
+            journal.done(job["rel_json"])
+    metrics.count("finished")
+    metrics.log(f"Processed {job['file']} - Saved to {job['output_path']}", VERBOSE)
+
+def complete_job(job, waiting, output_cache, journal=None):
+    """Store a generated line in the cache and give its duplicates the same audio.
+    Lines that failed the quality gate aren't cached, so they're generated again next time.
+    Returns the number of lines finished."""
+    if output_cache is not None and not job.get("quality_problems"):
+        for ext, path in cached_outputs(job):
+            output_cache.put(job["cache_key"], path, ext)
+    finish_job(job, journal)
+    # Identical lines elsewhere get the same audio
+    for duplicate in waiting[planned_key(job)]:
+        duplicate["quality_problems"] = job.get("quality_problems")
+        link_or_copy(job["output_path"], duplicate["output_path"])
+        if duplicate["new_wav_path"] is not None and duplicate["new_wav_path"] != duplicate["output_path"]:
+            link_or_copy(job["new_wav_path"], duplicate["new_wav_path"])
+        finish_job(duplicate, journal)
+    return 1 + len(waiting[planned_key(job)])
+
+def fail_job(job, waiting, error, journal=None):
+    """Give a line and its duplicates back to the journal after an error."""
+    print(f"Failed {job['file']}: {error}")
+    instrumentation.get("step2").count("failed")
+    if journal is not None:
+        for failed in [job] + waiting.get(planned_key(job), []):
+            journal.failed(failed["rel_json"], error)
+
+def drain_encoded(pending, waiting, output_cache, wait=False, journal=None):
+    """Finish the jobs whose OGG has been encoded. Returns (still pending, lines finished)."""
+    still_pending = []
+    finished = 0
+    for future, job in pending:
+        if not wait and not future.done():
+            still_pending.append((future, job))
+            continue
+        try:
+            future.result()
+        except Exception as e:
+            fail_job(job, waiting, f"Encoding failed: {e}", journal)
+            continue
+        finished += complete_job(job, waiting, output_cache, journal)
+    return still_pending, finished
+
+def generate_jobs(jobs, output_cache, tts=None, journal=None, total=None, ref_index=None):
+    """Generate a list of jobs, reusing cached and duplicate lines. Lines that fail the
+    quality gate are queued again at the end, ref_index is used to pick them another
+    reference. total is the number of lines for the progress line. Returns (lines finished, the TTS backend so the next call
+    can reuse it)."""
+    metrics = instrumentation.get("step2")
+    processed_files = 0
+    to_generate, waiting, cached = dedupe_jobs(jobs, output_cache)
+    for job in cached:
+        with metrics.span("cache", job["rel_json"]):
+            for ext, path in cached_outputs(job):
+                output_cache.materialise(job["cache_key"], path, ext)
+        finish_job(job, journal)
+        processed_files += 1
+    duplicates = sum(len(dupes) for dupes in waiting.values())
+    metrics.count("cached", len(cached))
+    metrics.count("duplicates", duplicates)
+    metrics.log(f"{len(cached)} lines reused from the cache, {duplicates} duplicates of other lines.", VERBOSE or journal is None)
+
+    batches = make_batches(to_generate, BATCH_SIZE)
+    metrics.log(f"{len(to_generate)} lines to generate in {len(batches)} batches of up to {BATCH_SIZE}.", VERBOSE or journal is None)
+    if not batches:
+        return processed_files, tts
+
+    if tts is None:
+        with metrics.span("load_model"):
+            tts = get_tts()
+    encoder = OggEncoderPool(metrics=metrics) if FUSED_OGG_OUTPUT else None
+    pending = []  # (encode future, job)
+    for number, batch in enumerate(batches):
+        start = time.perf_counter()
+        try:
+            results = generate_batch(tts, batch)
+        except Exception as e:
+            if journal is None:
+                raise
+            for job in batch:
+                fail_job(job, waiting, e, journal)
+            continue
+        elapsed = time.perf_counter() - start
+        metrics.observe(f"batch{len(batch)}", elapsed)
+        for job in batch:
+            metrics.observe("infer", elapsed / len(batch), job["rel_json"])
+        metrics.count("generated", len(batch))
+
+        passed, retries = gate_results(batch, results, ref_index)
+        batches.extend(make_batches(retries, BATCH_SIZE))
+        for job, wav, sr in passed:
+            # Jobs without an OGG (audition.py's) are plain WAVs even with FUSED_OGG_OUTPUT
+            if encoder is not None and job["new_ogg_path"] is not None:
+                pending.append((encoder.submit(wav, sr, job["new_ogg_path"]), job))
+            else:
+                processed_files += complete_job(job, waiting, output_cache, journal)
+        if pending:
+            pending, finished = drain_encoded(pending, waiting, output_cache, journal=journal)
+            processed_files += finished
+        if journal is not None:
+            # Keep the lease on the lines still to come
+            journal.renew([job["rel_json"] for later in batches[number + 1:] for job in later])
+        metrics.progress(metrics.counters.get("finished", 0), total)
+
+    if encoder is not None:
+        encoder.close()
+        _, finished = drain_encoded(pending, waiting, output_cache, wait=True, journal=journal)
+        processed_files += finished
+    return processed_files, tts
+
+def print_throughput():
+    """Lines per second for every batch size that was used."""
+    metrics = instrumentation.get("step2")
+    for name, histogram in sorted(metrics.histograms.items()):
+        if name.startswith("batch") and histogram.sum:
+            size = int(name[len("batch"):])
+            lines = histogram.count * size
+            print(f"Batch size {size}: {lines} lines in {histogram.sum:.1f}s, {lines / histogram.sum:.2f} lines/s")
+
+def drain_journal(jobs, output_cache, journal, ref_index=None):
+    """Claim lines from the journal and generate them until there are none left. While
+    other workers still hold leases, wait: if they crash, their lines are taken over."""
+    by_rel_json = {job["rel_json"]: job for job in jobs}
+    missing = set()  # Lines other workers have but this one doesn't, left to them
+    # Lines the journal hasn't seen yet count as done if both their audio and JSON exist
+    known = journal.known()
+    already_done = {job["rel_json"] for job in jobs if job["rel_json"] not in known
+                    and os.path.exists(job["output_path"]) and os.path.exists(job["new_json_path"])}
+    journal.sync(jobs, already_done)
+    counts = journal.counts()
+    total = counts.get("pending", 0) + counts.get("running", 0)
+    processed_files = 0
+    tts = None
+    while True:
+        claimed = journal.claim(CLAIM_SIZE, missing)
+        if not claimed:
+            running = journal.others_running()
+            if not running:
+                return processed_files
+            print(f"Waiting for {running} lines other workers are generating...")
+            time.sleep(min(30, journal.lease_seconds))
+            continue
+        not_here = [rel_json for rel_json in claimed if rel_json not in by_rel_json]
+        if not_here:
+            missing.update(not_here)
+            journal.release(not_here)
+            print(f"{len(not_here)} lines in the journal aren't in this worker's OrigData, leaving them to the others.")
+        finished, tts = generate_jobs([by_rel_json[rel_json] for rel_json in claimed if rel_json in by_rel_json],
+                                      output_cache, tts, journal, total, ref_index)
+        processed_files += finished
+
+def load_references():
+    """Open step 1's output and index its references. Returns (pack or None, ReferenceIndex)."""
+    if PACK_DIR:
+        if REF_CACHE_DIR is None and TTS_BACKEND != "worker":
+            raise RuntimeError("Reading from a pack needs REF_CACHE_DIR, references are written out from the pack into it.")
+        pack = PackedStore(PACK_DIR)
+        ref_index = ReferenceIndex(NEW_DATA_DIR).load_pack(pack)
+    elif LAZY_OGG_DIR:
+        if REF_CACHE_DIR is None and TTS_BACKEND != "worker":
+            raise RuntimeError("LAZY_OGG_DIR needs REF_CACHE_DIR, references are decoded into it when first used.")
+        pack = None
+        ref_index = ReferenceIndex(LAZY_OGG_DIR, REF_INDEX_PATH, ext=".ogg", full_analysis=False).build()
+    else:
+        pack = None
+        ref_index = ReferenceIndex(NEW_DATA_DIR, REF_INDEX_PATH).build()
+    return pack, ref_index
+
+def process_jsons_and_generate(journal=None, dry_run=False):
+    pack, ref_index = load_references()
+    output_cache = OutputCache(OUTPUT_CACHE_DIR) if OUTPUT_CACHE_DIR else None
+
+    table, contents_by_line = plan(ref_index, pack)
+    if dry_run:
+        print_plan(table, output_cache)
+        return
+
+    if journal is None:
+        jobs, skipped_files = jobs_from_table(table, contents_by_line, pack)
+        processed_files, _ = generate_jobs(jobs, output_cache, total=len(jobs), ref_index=ref_index)
+        print_throughput()
+        instrumentation.get("step2").finish()
+        print(f"Finished Step 2: {processed_files} files processed, {skipped_files} skipped (already exist).")
+    else:
+        jobs, _ = jobs_from_table(table, contents_by_line, pack, skip_existing=False)
+        processed_files = drain_journal(jobs, output_cache, journal, ref_index)
+        print_throughput()
+        instrumentation.get("step2").finish()
+        counts = journal.counts()
+        print(f"Finished Step 2: {processed_files} files processed by this worker. Journal: "
+              f"{counts.get('done', 0)} done, {counts.get('failed', 0)} failed, {counts.get('pending', 0)} pending.")
 
 
 # === RUN SCRIPT ===
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the lines from step 1 with the new name.")
+    parser.add_argument("--journal", default=JOURNAL_PATH, help="Job journal to resume from and share with other workers")
+    parser.add_argument("--shard", default="0/1", help="Take lines of shard i out of N first, e.g. 0/2 and 1/2 on two machines")
+    parser.add_argument("--worker-id", default=None, help="Name of this worker in the journal (default: host-pid)")
+    parser.add_argument("--retry-failed", action="store_true", help="Give lines that failed too often another go")
+    parser.add_argument("--dry-run", action="store_true", help="Only plan the lines and print what would be generated")
+    parser.add_argument("--preview-name", metavar="NAME", help="List the lines the saved plan would generate with this name")
+    args = parser.parse_args()
+    if not args.journal and (args.retry_failed or args.shard != "0/1"):
+        parser.error("--shard and --retry-failed need a journal, pass --journal data/step2_jobs.sqlite")
+    if args.preview_name:
+        preview_name(args.preview_name, OutputCache(OUTPUT_CACHE_DIR) if OUTPUT_CACHE_DIR else None)
+        sys.exit(0)
     print(f"🚀 Starting Step 2: Generating new audio via API (Replacing *NAME* with '{SPECIFIED_NAME}')...")
     os.makedirs(CUSTOM_DATA_DIR, exist_ok=True)  # Ensure base folder exists
-    process_jsons_and_generate()
-    print("CustomData is ready. Run step3_convert_wav_to_ogg.py next!")
\ No newline at end of file
+    journal = None
+    if args.journal and not args.dry_run:
+        journal = JobJournal(args.journal, args.worker_id, parse_shard(args.shard))
+        if args.retry_failed:
+            journal.retry_failed()
+    try:
+        process_jsons_and_generate(journal, args.dry_run)
+    finally:
+        if journal is not None:
+            journal.close()
+    if args.dry_run:
+        sys.exit(0)
+    if FUSED_OGG_OUTPUT:
+        print("FinalOggData is ready, no need to run step 3.")
+    else:
+        print("CustomData is ready. Run step3_convert_wav_to_ogg.py next!")
\ No newline at end of file
@@ -1,37 +1,81 @@
 import os
 import sys
+import json
 import traceback
 import soundfile as sf
 import logging
 import subprocess
+import instrumentation
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ogg_encoder import encode_pcm_to_ogg
 
 # === CONFIGURATION ===
 CUSTOM_DATA_DIR = "data/CustomData"
 CONVERTED_DATA_DIR = "data/FinalOggData"
 MAX_PATH_LENGTH = 260
 LOG_FILE = "conversion_errors.log"
+# Which WAV (size, mtime, inode) each OGG was converted from. Step 2 can put an older file
+# from its output cache in place of a WAV, so the WAV's mtime alone doesn't say if it changed.
+STATE_PATH = "data/step3_state.json"
+STATE_SAVE_EVERY = 500  # Save the state every this many conversions, so a killed run keeps most of them
+WORKERS = os.cpu_count() or 1  # Conversions running at once
+# Encode in-process with PyAV (pip install av) instead of starting ffmpeg for every file
+USE_PYAV = False
+# Per-file messages are only logged with VERBOSE, otherwise there's a progress line
+VERBOSE = False
 
-# === SET UP LOGGING ===
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
-console = logging.StreamHandler()
-console.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+def setup_logging():
+    logging.basicConfig(
+        filename=LOG_FILE,
+        level=logging.DEBUG if VERBOSE else logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    console = logging.StreamHandler()
+    console.setLevel(logging.DEBUG if VERBOSE else logging.INFO)
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    console.setFormatter(formatter)
+    logging.getLogger('').addHandler(console)
 
 def flush_logs():
     for handler in logging.root.handlers:
         handler.flush()
 
+def wav_stat(wav_path):
+    st = os.stat(wav_path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def load_state():
+    """{WAV path relative to CUSTOM_DATA_DIR: wav_stat() it was last converted from}"""
+    try:
+        with open(STATE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_state(state):
+    os.makedirs(os.path.dirname(STATE_PATH) or ".", exist_ok=True)
+    tmp_path = STATE_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, STATE_PATH)
+
+def is_up_to_date(wav_path, ogg_path, converted_from=None):
+    """An OGG doesn't need converting again if its WAV is still the one it was converted
+    from. OGGs from before the state file was kept count if they're newer than their WAV."""
+    try:
+        if not os.path.exists(ogg_path):
+            return False
+        if converted_from is not None:
+            return wav_stat(wav_path) == converted_from
+        return os.path.getmtime(ogg_path) >= os.path.getmtime(wav_path)
+    except FileNotFoundError:
+        return False
+
 def convert_wav_to_ogg(wav_path, ogg_path):
-    """Convert a WAV file to OGG using ffmpeg instead of soundfile."""
+    """Convert a WAV file to OGG using ffmpeg (or PyAV) instead of soundfile."""
     try:
         # Check Path Length
-        if len(ogg_path) > 260:
+        if len(ogg_path) > MAX_PATH_LENGTH:
             logging.error(f"Skipping (path too long): {ogg_path}")
             return False
 
@@ -42,65 +86,97 @@ def convert_wav_to_ogg(wav_path, ogg_path):
             logging.error(f"Failed to create directory: {e}")
             return False
 
-        print(f"Converting {wav_path} -> {ogg_path}")
-        logging.info(f"Converting {wav_path} -> {ogg_path}")
+        logging.debug(f"Converting {wav_path} -> {ogg_path}")
+
+        if USE_PYAV:
+            data, samplerate = sf.read(wav_path, dtype="float32")
+            encode_pcm_to_ogg(data, samplerate, ogg_path, use_pyav=True)
+            return True
 
         # Use ffmpeg for conversion instead of soundfile
+        tmp_path = ogg_path[:-len(".ogg")] + ".tmp.ogg"
         try:
-            # Run ffmpeg with appropriate parameters
-            result = subprocess.run(
-                ['ffmpeg', '-i', wav_path, '-c:a', 'libopus', '-b:a', '64k', ogg_path],
+            # Run ffmpeg with appropriate parameters, into a temporary file so an
+            # interrupted conversion doesn't look up to date next time
+            subprocess.run(
+                ['ffmpeg', '-y', '-i', wav_path, '-c:a', 'libopus', '-b:a', '64k', tmp_path],
                 check=True,
                 capture_output=True,
                 text=True
             )
-            print("Conversion successful")
+            os.replace(tmp_path, ogg_path)
             return True
         except subprocess.CalledProcessError as e:
             logging.error(f"FFmpeg conversion failed for {wav_path}: {e.stderr}")
-            print(f"FFmpeg error: {e.stderr}")
             return False
         except FileNotFoundError:
             logging.error("FFmpeg not found. Please install FFmpeg and ensure it's in your PATH.")
-            print("FFmpeg not found. Please install FFmpeg and ensure it's in your PATH.")
             return False
 
     except Exception as e:
         logging.error(f"❌ Error converting {wav_path}:\n{traceback.format_exc()}")
-        flush_logs()
         return False
 
+def find_conversions(state):
+    """Return the (wav, ogg) pairs that need converting and how many are already up to date."""
+    jobs = []
+    up_to_date = 0
+    for root, _, files in os.walk(CUSTOM_DATA_DIR):
+        for file in files:
+            if file.endswith(".wav") and not file.endswith(".tmp.wav"):
+                wav_path = os.path.join(root, file)
+                # Compute relative path & target location
+                rel_path = os.path.relpath(root, CUSTOM_DATA_DIR)
+                ogg_path = os.path.join(CONVERTED_DATA_DIR, rel_path, file.replace(".wav", ".ogg"))
+                if is_up_to_date(wav_path, ogg_path, state.get(os.path.relpath(wav_path, CUSTOM_DATA_DIR))):
+                    up_to_date += 1
+                else:
+                    jobs.append((wav_path, ogg_path))
+    return jobs, up_to_date
+
+def timed_conversion(metrics, wav_path, ogg_path):
+    with metrics.span("encode", ogg_path):
+        return convert_wav_to_ogg(wav_path, ogg_path)
+
 def convert_custom_wav_to_ogg():
+    metrics = instrumentation.get("step3")
     converted_files = 0
     skipped_files = 0
+    state = load_state()
     try:
-        for root, _, files in os.walk(CUSTOM_DATA_DIR):
-            for file in files:
-                if file.endswith(".wav"):
+        jobs, up_to_date = find_conversions(state)
+        metrics.count("up_to_date", up_to_date)
+        logging.info(f"{len(jobs)} files to convert, {up_to_date} already up to date. Using {WORKERS} workers.")
+
+        try:
+            with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+                futures = {pool.submit(timed_conversion, metrics, wav_path, ogg_path): (wav_path, ogg_path)
+                           for wav_path, ogg_path in jobs}
+                for future in as_completed(futures):
+                    wav_path, ogg_path = futures[future]
                     try:
-                        wav_path = os.path.join(root, file)
-                        # Compute relative path & target location
-                        rel_path = os.path.relpath(root, CUSTOM_DATA_DIR)
-                        ogg_path = os.path.join(CONVERTED_DATA_DIR, rel_path, file.replace(".wav", ".ogg"))
-                        
-                        # Convert WAV to OGG
-                        success = convert_wav_to_ogg(wav_path, ogg_path)
-                        if success:
-                            converted_files += 1
-                            logging.info(f"✅ Converted {converted_files}: {wav_path} -> {ogg_path}")
-                        else:
-                            skipped_files += 1
-                            print(f"Skipped file {wav_path}")
+                        success = future.result()
                     except Exception as e:
-                        logging.error(f"Error processing file {file}:\n{traceback.format_exc()}")
+                        logging.error(f"Error processing file {wav_path}:\n{traceback.format_exc()}")
+                        success = False
+                    if success:
+                        state[os.path.relpath(wav_path, CUSTOM_DATA_DIR)] = wav_stat(wav_path)
+                        converted_files += 1
+                        metrics.count("converted")
+                        logging.debug(f"✅ Converted {converted_files}: {wav_path} -> {ogg_path}")
+                        if converted_files % STATE_SAVE_EVERY == 0:
+                            save_state(state)
+                    else:
                         skipped_files += 1
-                    flush_logs()
-                    
-                    # Print progress every 100 files
-                    if converted_files % 100 == 0 and converted_files > 0:
-                        logging.info(f"Progress: {converted_files} files converted, {skipped_files} skipped")
-                        
-        logging.info(f"🎉 Finished: {converted_files} files converted; {skipped_files} skipped.")
+                        metrics.count("skipped")
+                        logging.debug(f"Skipped file {wav_path}")
+                    metrics.progress(converted_files + skipped_files, len(jobs))
+        finally:
+            # Also when the run fails or is interrupted, so the finished files aren't converted again
+            save_state(state)
+
+        metrics.finish()
+        logging.info(f"🎉 Finished: {converted_files} files converted; {skipped_files} skipped; {up_to_date} already up to date.")
         flush_logs()
     except Exception as e:
         logging.error(f"🚨 Fatal error in conversion loop:\n{traceback.format_exc()}")
@@ -108,18 +184,27 @@ def convert_custom_wav_to_ogg():
 
 # === RUN SCRIPT ===
 if __name__ == "__main__":
-    logging.info("🚀 Starting WAV to OGG conversion using FFmpeg...")
+    setup_logging()
+    logging.info("🚀 Starting WAV to OGG conversion...")
     os.makedirs(CONVERTED_DATA_DIR, exist_ok=True)
-    
-    # Check if ffmpeg is available
-    try:
-        subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-        logging.info("FFmpeg is available and will be used for conversion")
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        logging.error("FFmpeg not found or not working properly. Please install FFmpeg.")
-        print("Error: FFmpeg not found or not working properly. Please install FFmpeg.")
-        sys.exit(1)
-        
+
+    if USE_PYAV:
+        try:
+            import av
+            logging.info("PyAV is available and will be used for conversion")
+        except ImportError:
+            logging.error("PyAV not found. Install it with 'pip install av' or set USE_PYAV = False.")
+            sys.exit(1)
+    else:
+        # Check if ffmpeg is available
+        try:
+            subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
+            logging.info("FFmpeg is available and will be used for conversion")
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            logging.error("FFmpeg not found or not working properly. Please install FFmpeg.")
+            print("Error: FFmpeg not found or not working properly. Please install FFmpeg.")
+            sys.exit(1)
+
     convert_custom_wav_to_ogg()
     logging.info("✅ Conversion script finished.")
-    flush_logs()
\ No newline at end of file
+    flush_logs()
@@ -0,0 +1,97 @@
+import os
+import sys
+import numpy as np
+import soundfile as sf
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pipeline
+import quality_gate
+import instrumentation
+import step1_generate_newdata as step1
+import step2_generate_customdata as step2
+import step3_convert_wav_to_ogg as step3
+
+LINES = {
+    # Three identical lines with the same audio, so the same reference and cache key
+    "1": ("Hello _NAME_, how are you", 220),
+    "2": ("Hello _NAME_, how are you", 220),
+    "3": ("Something else for _NAME_", 330),
+    "4": ("Hello _NAME_, how are you", 220),
+}
+
+def write_line(directory, number, sentence, pitch):
+    with open(os.path.join(directory, f"{number}.json"), "w", encoding="utf-8") as f:
+        f.write(f'{{"sentence": "{sentence}", "speaker": "Bob"}}')
+    t = np.arange(4 * 24000) / 24000
+    sf.write(os.path.join(directory, f"{number}.ogg"), 0.3 * np.sin(2 * np.pi * pitch * t), 24000,
+             format="OGG", subtype="VORBIS")
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    source = tmp_path / "Data" / "Bob"
+    source.mkdir(parents=True)
+    for number, (sentence, pitch) in LINES.items():
+        write_line(source, number, sentence, pitch)
+    work = tmp_path / "work"
+    for name, value in {"SOURCE_DIR": tmp_path / "Data", "NEW_DATA_DIR": work / "OrigData",
+                        "ORIGINAL_OGG_DIR": work / "OriginalOggs", "CUSTOM_DATA_DIR": work / "CustomData",
+                        "CONVERTED_DATA_DIR": work / "FinalOggData", "STATE_PATH": work / "state.json"}.items():
+        monkeypatch.setattr(pipeline, name, str(value))
+    monkeypatch.setattr(pipeline, "LEXICON_PATH", None)
+    monkeypatch.setattr(step1, "MANIFEST_PATH", str(work / "step1_manifest.json"))
+    monkeypatch.setattr(step1, "DEPLOY_MANIFEST_PATH", str(work / "deploy_manifest.json"))
+    monkeypatch.setattr(step1, "WORKERS", 1)
+    monkeypatch.setattr(step2, "TTS_BACKEND", "stub")
+    monkeypatch.setattr(step2, "REF_CACHE_DIR", str(work / "RefCache"))
+    monkeypatch.setattr(step2, "REF_INDEX_PATH", str(work / "reference_index.json"))
+    monkeypatch.setattr(step2, "OUTPUT_CACHE_DIR", str(work / "GenCache"))
+    monkeypatch.setattr(step2, "BATCH_SIZE", 1)
+    monkeypatch.setattr(instrumentation, "METRICS_DIR", None)
+    # No ffmpeg needed, step 3 isn't what's tested here
+    monkeypatch.setattr(step3, "timed_conversion", lambda metrics, wav_path, ogg_path: True)
+    # Module settings that configure() changes
+    for module, names in ((step1, ("SOURCE_DIR", "NEW_DATA_DIR", "ORIGINAL_OGG_DIR", "PACK_OUTPUT", "LAZY_DECODE")),
+                          (step2, ("NEW_DATA_DIR", "PACK_DIR", "LAZY_OGG_DIR", "CUSTOM_DATA_DIR",
+                                   "CONVERTED_DATA_DIR", "FUSED_OGG_OUTPUT")),
+                          (step3, ("CUSTOM_DATA_DIR", "CONVERTED_DATA_DIR"))):
+        for name in names:
+            monkeypatch.setattr(module, name, getattr(module, name))
+    return work
+
+def generated(work):
+    return sorted(name for name in os.listdir(work / "CustomData" / "Bob") if name.endswith(".wav"))
+
+def test_duplicate_lines_without_cache(tree, monkeypatch):
+    monkeypatch.setattr(step2, "OUTPUT_CACHE_DIR", None)
+    pipeline.run_pipeline()
+    assert generated(tree) == ["1.wav", "2.wav", "3.wav", "4.wav"]
+
+def test_duplicates_of_a_line_that_failed_the_gate(tree, monkeypatch):
+    check = quality_gate.check
+    calls = []
+
+    def fail_first(*args, **kwargs):
+        calls.append(1)
+        return ["broken"] if len(calls) == 1 else check(*args, **kwargs)
+
+    monkeypatch.setattr(quality_gate, "check", fail_first)
+    monkeypatch.setattr(step2, "QUALITY_GATE", True)
+    pipeline.run_pipeline()
+    assert generated(tree) == ["1.wav", "2.wav", "3.wav", "4.wav"]
+
+def test_duplicates_of_a_line_that_failed_to_generate(tree, monkeypatch):
+    monkeypatch.setattr(step2, "OUTPUT_CACHE_DIR", None)
+    generate_batch = step2.generate_batch
+    calls = []
+
+    def fail_first(tts, batch):
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("out of memory")
+        return generate_batch(tts, batch)
+
+    monkeypatch.setattr(step2, "generate_batch", fail_first)
+    pipeline.run_pipeline()
+    # The failed line itself is left for the next run, its duplicates aren't lost with it
+    assert len(generated(tree)) == 3
@@ -0,0 +1,66 @@
+import os
+import sys
+import socket
+import threading
+from multiprocessing.connection import Client
+import numpy as np
+import soundfile as sf
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import tts_worker
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    """A stub worker serving on a free local port, stopped again after the test."""
+    monkeypatch.setattr(tts_worker, "WORKER_AUTHKEY_PATH", str(tmp_path / "worker_key"))
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        address = ("127.0.0.1", s.getsockname()[1])
+    backend = tts_worker.load_backend("stub", ref_cache_dir=str(tmp_path / "RefCache"))
+    authkey = tts_worker.load_authkey(create=True)
+    thread = threading.Thread(target=tts_worker.serve, args=(backend, address, authkey), daemon=True)
+    thread.start()
+    for _ in range(100):
+        try:
+            client = tts_worker.TTSClient(address)
+            break
+        except RuntimeError:
+            thread.join(0.05)
+    yield client
+    client.stop_worker()
+    client.close()
+    # Wake the listener up so it notices the stop flag
+    Client(address, authkey=authkey).close()
+    thread.join(5)
+    assert not thread.is_alive()
+
+@pytest.fixture
+def reference(tmp_path):
+    path = tmp_path / "ref.wav"
+    t = np.arange(4 * 24000) / 24000
+    sf.write(path, 0.3 * np.sin(2 * np.pi * 220 * t), 24000)
+    return str(path)
+
+def test_infer_writes_wav(worker, reference, tmp_path):
+    out = tmp_path / "out.wav"
+    wav, sr, _ = worker.infer(reference, "", "Hello there", file_wave=str(out))
+    assert sr == 24000
+    assert len(wav) > 0
+    written, written_sr = sf.read(out, dtype="float32")
+    assert written_sr == 24000
+    assert np.allclose(written, wav, atol=1e-4)
+
+def test_infer_batch_returns_every_line(worker, reference, tmp_path):
+    gen_texts = ["Short", "A much longer line of text"]
+    outs = [str(tmp_path / f"{i}.wav") for i in range(len(gen_texts))]
+    results = worker.infer_batch(reference, "", gen_texts, file_waves=outs)
+    assert len(results) == 2
+    assert len(results[1][0]) > len(results[0][0])
+    for (wav, sr, _), out in zip(results, outs):
+        assert sr == 24000
+        assert sf.info(out).frames == len(wav)
+
+def test_failed_job_is_reported(worker, tmp_path):
+    with pytest.raises(RuntimeError, match="TTS worker failed"):
+        worker.infer(str(tmp_path / "missing.wav"), "", "Hello")
@@ -0,0 +1,197 @@
+"""Long running TTS worker, so F5-TTS only has to be loaded and warmed up once.
+
+Start it in its own terminal and leave it running while you try name spellings:
+
+    python tts_worker.py                  # loads F5-TTS
+    python tts_worker.py --backend stub   # no model, CPU only, for testing
+    python tts_worker.py --stop           # stop a running worker
+
+Then set TTS_BACKEND = "worker" in step2_generate_customdata.py. Step 2 sends its jobs
+over a local socket and gets each waveform back as soon as it's generated.
+"""
+import os
+import shutil
+import secrets
+import argparse
+import threading
+import traceback
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
+import numpy as np
+import soundfile as sf
+from reference_cache import CachedReferenceTTS
+
+WORKER_ADDRESS = ("127.0.0.1", 6123)  # Only listens locally
+# Random key that clients need to connect, made on the first start and only readable by
+# you. Whoever has it can make the worker run code, as it unpickles what it's sent.
+WORKER_AUTHKEY_PATH = os.path.join(os.path.expanduser("~"), ".xivv_tts_worker_key")
+REF_CACHE_DIR = "data/RefCache"  # Preprocessed reference audio + transcripts
+
+class StubTTS:
+    """CPU stand-in for F5TTS with the same infer() signature.
+    Generates a quiet tone whose length follows the text length and speed, so the rest
+    of the pipeline can be run and timed without a GPU or the model."""
+    target_sample_rate = 24000
+
+    def infer(self, ref_file, ref_text, gen_text, file_wave=None, seed=None, nfe_step=32, speed=1.0, **kwargs):
+        sr = self.target_sample_rate
+        duration = max(0.5, len(gen_text) * 0.06 / speed)
+        t = np.arange(int(duration * sr)) / sr
+        wav = (0.1 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+        if file_wave is not None:
+            sf.write(file_wave, wav, sr)
+        return wav, sr, None
+
+    def infer_batch(self, ref_file, ref_text, gen_texts, file_waves=None, **kwargs):
+        return [self.infer(ref_file, ref_text, gen_text, file_wave=file_waves[i] if file_waves else None, **kwargs)
+                for i, gen_text in enumerate(gen_texts)]
+
+    def preprocess_reference(self, ref_file, out_path):
+        shutil.copyfile(ref_file, out_path)
+        return "Stub reference transcript."
+
+def load_backend(name, ref_cache_dir=None):
+    """Create a TTS backend by name, "f5" for the real model or "stub" for StubTTS.
+    If ref_cache_dir is given, references are preprocessed and transcribed once and cached there."""
+    if name == "stub":
+        backend = StubTTS()
+    elif name == "f5":
+        from f5_batch import BatchedF5TTS
+        backend = BatchedF5TTS()
+    else:
+        raise ValueError(f"Unknown TTS backend: {name}")
+    if ref_cache_dir is not None:
+        backend = CachedReferenceTTS(backend, ref_cache_dir)
+    return backend
+
+def load_authkey(create=False):
+    """Read the worker key, making a new one if create is set and there isn't one yet."""
+    try:
+        with open(WORKER_AUTHKEY_PATH, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        if not create:
+            raise RuntimeError(f"No TTS worker key in {WORKER_AUTHKEY_PATH}, start the worker first: python tts_worker.py")
+    key = secrets.token_bytes(32)
+    # O_EXCL so two workers starting at once can't end up with different keys
+    try:
+        fd = os.open(WORKER_AUTHKEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o600)
+    except FileExistsError:
+        return load_authkey()
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+class TTSClient:
+    """Talks to a running worker. infer() can be used in place of F5TTS.infer()."""
+
+    def __init__(self, address=WORKER_ADDRESS, authkey=None):
+        if authkey is None:
+            authkey = load_authkey()
+        try:
+            self.conn = Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            raise RuntimeError(f"No TTS worker running on {address[0]}:{address[1]}, start it with: python tts_worker.py")
+
+    def _job(self, kwargs):
+        # The worker may have a different working directory
+        kwargs = dict(kwargs)
+        if isinstance(kwargs["ref_file"], str):
+            kwargs["ref_file"] = os.path.abspath(kwargs["ref_file"])
+        if kwargs.get("file_wave") is not None:
+            kwargs["file_wave"] = os.path.abspath(kwargs["file_wave"])
+        if kwargs.get("file_waves") is not None:
+            kwargs["file_waves"] = [os.path.abspath(path) for path in kwargs["file_waves"]]
+        return kwargs
+
+    def infer(self, ref_file, ref_text, gen_text, **kwargs):
+        job = dict(kwargs, ref_file=ref_file, ref_text=ref_text, gen_text=gen_text)
+        self.conn.send({"op": "infer", "jobs": [self._job(job)]})
+        return self._receive()
+
+    def infer_batch(self, ref_file, ref_text, gen_texts, file_waves=None, **kwargs):
+        """Run one batched generation on the worker, see BatchedF5TTS.infer_batch()."""
+        job = dict(kwargs, ref_file=ref_file, ref_text=ref_text, gen_texts=gen_texts, file_waves=file_waves)
+        self.conn.send({"op": "infer_batch", "jobs": [self._job(job)]})
+        return [self._receive() for _ in gen_texts]
+
+    def _receive(self):
+        reply = self.conn.recv()
+        if not reply["ok"]:
+            raise RuntimeError(f"TTS worker failed:\n{reply['error']}")
+        return reply["wav"], reply["sr"], None
+
+    def stop_worker(self):
+        self.conn.send({"op": "stop"})
+        self.conn.recv()
+
+    def close(self):
+        self.conn.close()
+
+def handle_connection(backend, lock, conn, stop):
+    with conn:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                return
+            if request["op"] == "stop":
+                stop.set()
+                conn.send({"ok": True})
+                return
+            for job in request["jobs"]:
+                try:
+                    # One job on the GPU at a time, even with several clients connected
+                    with lock:
+                        if request["op"] == "infer_batch":
+                            results = backend.infer_batch(**job)
+                        else:
+                            results = [backend.infer(**job)]
+                    for wav, sr, _ in results:
+                        conn.send({"ok": True, "wav": np.asarray(wav), "sr": sr})
+                except Exception:
+                    error = {"ok": False, "error": traceback.format_exc()}
+                    for _ in job.get("gen_texts", [None]):
+                        conn.send(error)
+
+def serve(backend, address=WORKER_ADDRESS, authkey=None):
+    if authkey is None:
+        authkey = load_authkey(create=True)
+    lock = threading.Lock()
+    stop = threading.Event()
+    with Listener(address, authkey=authkey) as listener:
+        print(f"TTS worker ready on {address[0]}:{address[1]}")
+        while not stop.is_set():
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError, OSError) as e:
+                print(f"Refused a connection: {e}")
+                continue
+            threading.Thread(target=handle_connection, args=(backend, lock, conn, stop), daemon=True).start()
+    print("TTS worker stopped.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep a TTS model loaded and serve step 2's jobs.")
+    parser.add_argument("--backend", default="f5", choices=["f5", "stub"], help="Model to load")
+    parser.add_argument("--port", type=int, default=WORKER_ADDRESS[1])
+    parser.add_argument("--ref-cache", default=REF_CACHE_DIR, help="Reference cache folder")
+    parser.add_argument("--stop", action="store_true", help="Stop a running worker")
+    args = parser.parse_args()
+    address = (WORKER_ADDRESS[0], args.port)
+
+    if args.stop:
+        client = TTSClient(address)
+        client.stop_worker()
+        # Wake the listener up so it notices the stop flag
+        client.close()
+        try:
+            Client(address, authkey=load_authkey()).close()
+        except (ConnectionRefusedError, EOFError):
+            pass
+        return
+
+    print(f"Loading {args.backend} backend...")
+    serve(load_backend(args.backend, args.ref_cache), address)
+
+if __name__ == "__main__":
+    main()